@@ -1,7 +1,7 @@
 # @String(label="Experiment Title", description="Set the title of your experiment") Title
 # @File(label="Select a file") Experiment
 # @File(label="Select Root directory", style="directory") Root
-# @File(label="Select Image Classifier") classifier
+# @File(label="Select Image Classifier", required=false) classifier
 # @Integer(label="Control series:", description="The number of baseline measurements", value=3) Control_num
 # @Integer(label="Stimulation number:", description="The number of stimulation protocols applied", value=1) Stim_num
 # @Boolean(label="Advanced settings", description="Set processing parameters", value=True) Adv_set
@@ -10,22 +10,35 @@ import os
 import sys
 import collections
 import ConfigParser
-import ast
 import time
-from math import sqrt
+from math import copysign, cos, pi
 from datetime import datetime
 
 import itertools
-from itertools import repeat, chain
+from itertools import repeat
 import json
-from jarray import array
-
-from ij import IJ, WindowManager, ImagePlus
+import hashlib
+import shutil
+import tempfile
+import threading
+import Queue
+from jarray import array, zeros
+from array import array as flat_array
+
+# NumPy runs the FRET math when importable, under Jython 
+# the array module fallback is used.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ij import IJ, WindowManager, ImagePlus, ImageStack, Prefs
 from ij.gui import GenericDialog
 from ij.gui import Roi
 from ij.gui import Plot
 from ij.gui import WaitForUserDialog
-from ij.measure import ResultsTable
+from ij.io import FileSaver
+from ij.measure import Measurements
 from ij.plugin import ZProjector
 from ij.plugin import CompositeConverter
 from ij.plugin import ImageCalculator
@@ -33,30 +46,147 @@ from ij.plugin import Duplicator
 from ij.plugin.filter import ThresholdToSelection
 from ij.plugin.filter import EDM
 from ij.plugin.filter import Binary
-from ij.plugin.filter import Analyzer
 from ij.plugin.filter import BackgroundSubtracter
+from ij.plugin.filter import ParticleAnalyzer
 from ij.plugin.frame import RoiManager
 from ij.process import ImageConverter
 from ij.process import ImageProcessor
+from ij.process import ByteProcessor
+from ij.process import ShortProcessor
+from ij.process import ColorProcessor
+from ij.process import FloatProcessor
+from ij.process import Blitter
+from ij.process import ImageStatistics
+from ij.process import FHT
 from loci.formats import ImageReader
 from loci.formats import MetadataTools
+from loci.formats import ChannelSeparator
+from loci.formats import FormatTools
+from loci.formats import Memoizer
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
+from loci.plugins.util import ImageProcessorReader
+from loci.plugins.util import LociPrefs
 from loci.common import Region
+from loci.common import DataTools
 from fiji.threshold import Auto_Threshold
 
 from register_virtual_stack import Register_Virtual_Stack_MT
-import register_virtual_stack.Transform_Virtual_Stack_MT
+from register_virtual_stack import Transform_Virtual_Stack_MT
 from trainableSegmentation import WekaSegmentation
 import Watershed_Irregular_Features
+from mpicbg.models import CoordinateTransformList
+from mpicbg.models import CoordinateTransformMesh
+from mpicbg.models import NotEnoughDataPointsException
+from mpicbg.models import IllDefinedDataPointsException
+from mpicbg.trakem2.transform import TranslationModel2D
+from mpicbg.trakem2.transform import RigidModel2D
+from mpicbg.trakem2.transform import SimilarityModel2D
+from mpicbg.trakem2.transform import AffineModel2D
+from mpicbg.imagefeatures import FloatArray2DSIFT
+from mpicbg.ij import SIFT
+from mpicbg.ij import FeatureTransform
+from mpicbg.ij import TransformMeshMapping
 
 from ome.units import UNITS
 from java.awt import Color
 from java.awt import Dimension
 from java.awt import Panel
+from java.awt import Rectangle
+from java.awt.geom import AffineTransform
+from java.io import FileInputStream
+from java.io import IOException
+from java.io import RandomAccessFile
+from java.nio import ByteBuffer
+from java.nio import ByteOrder
+from java.nio.channels import FileChannel
+from java.io import FileOutputStream
+from java.io import ObjectInputStream
+from java.io import ObjectOutputStream
+from java.util import ArrayList
 from java.util import Vector
+from java.util.concurrent import Callable
+from java.util.concurrent import Executors
+from java.lang import ClassNotFoundException
+from java.lang import Runtime
+from java.lang import System
 from java.awt import Font
 
+# Helper modules shared with Timepoints.py live next to this script,
+# scripts started from the Fiji editor need them in Fiji.app/jars/Lib.
+try:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass
+import lif_metadata
+import running_stats
+
+# Parameter schema, key : (type, default, min, max). Choices are stored
+# as indices. Loaded and validated once by config_read()/typed_parameters(),
+# stages use the typed values directly.
+PARAMS = collections.OrderedDict([
+    # Registration.
+    ("steps", (int, 6, 1, None)),
+    ("max_oct", (int, 1024, 1, None)),
+    ("fd_size", (int, 12, 1, None)),
+    ("sigma", (float, 1.2, 0, None)),
+    ("max_eps", (float, 15.0, 0, None)),
+    ("min_inlier", (float, 0.05, 0, 1)),
+    ("shrinkage", (bool, False, None, None)),
+    ("feat_model", (int, 1, 0, 3)),
+    ("reg_model", (int, 1, 0, 5)),
+    ("phase_corr", (bool, True, None, None)),
+    ("reg_features", (bool, False, None, None)),
+    ("reg_chain", (int, 1, 0, None)),
+    # Background removal.
+    ("b_sub", (int, 0, 0, 1)),
+    ("ballsize", (float, 50.0, 0, None)),
+    ("create_b", (bool, False, None, None)),
+    ("light_b", (bool, False, None, None)),
+    ("parab", (bool, False, None, None)),
+    ("smooth", (bool, False, None, None)),
+    ("corners", (bool, False, None, None)),
+    ("b_engine", (int, 0, 0, 1)),
+    ("b_shrink", (int, 4, 1, None)),
+    ("b_reuse", (bool, False, None, None)),
+    ("b_reuse_tol", (float, 0.02, 0, None)),
+    # Segmentation (watershed, separator max 0 = no limit, tile 0 = whole image).
+    ("seg_engine", (int, 0, 0, 1)),
+    ("seg_method", (int, 0, 0, 3)),
+    ("seg_smooth", (float, 1.0, 0, None)),
+    ("ws_erosion", (float, 20.0, 0, None)),
+    ("ws_convexity", (float, 0.0, 0, 1)),
+    ("ws_sep_min", (float, 0.0, 0, None)),
+    ("ws_sep_max", (float, 0.0, 0, None)),
+    ("weka_tile", (int, 0, 0, None)),
+    ("weka_margin", (int, 32, 0, None)),
+    # Measurements.
+    ("cell_max", (float, 2200.0, 0, None)),
+    ("cell_min", (float, 200.0, 0, None)),
+    ("subtr_ratio", (float, 0.31, None, None)),
+    # Plots.
+    ("p_max", (float, 0.65, None, None)),
+    ("p_min", (float, 0.0, None, None)),
+    ("p_max_n", (float, 1.65, None, None)),
+    ("p_min_n", (float, 0.5, None, None)),
+    # Normalization (baseline window in minutes).
+    ("norm_mode", (int, 0, 0, 2)),
+    ("norm_start", (float, 0.0, None, None)),
+    ("norm_end", (float, 0.0, None, None)),
+    # Processing.
+    ("proj_mode", (int, 2, 0, 2)),
+    ("workers", (int, Runtime.getRuntime().availableProcessors(), 1, None)),
+    ("crop_x", (int, 0, 0, None)),
+    ("crop_y", (int, 0, 0, None)),
+    ("crop_w", (int, 0, 0, None)),
+    ("crop_h", (int, 0, 0, None)),
+    ("crop_auto", (bool, False, None, None)),
+    ("crop_margin", (int, 50, 0, None)),
+    ("aligned_raw", (bool, False, None, None)),
+    ])
+
+# Auto_Threshold methods of the classical segmentation engine.
+SEG_METHODS = ["IJDefault", "Otsu", "Huang", "Triangle"]
 
 def main():
     """ Master method and tabulator. """
@@ -71,9 +201,10 @@ def main():
         parameters = settings()
     else: 
         parameters = config_read()
+    IJ.log("Parameter set: " + parameter_hash(parameters))
     
     # Metadata parser    
-    channels, timepoints, timelist, timelist_unsorted, LP, org_size = meta_parser()
+    channels, timepoints, timelist, timelist_unsorted, LP, org_size = meta_parser(parameters)
             
     # User inputs
     if Stim_num >= 1:
@@ -85,23 +216,23 @@ def main():
     # Directory spawner.
     dirs = directorator(Title, str(Root))   
     
-    # Projections
-    imageprojector(channels, timelist_unsorted, dirs)
-            
-    # Composite image generator
-    Compositor(timepoints, channels, dirs)
+    # Projections and composite images (built from the in-memory projections).
+    imageprojector(channels, timelist_unsorted, dirs, parameters)
 
     # Background subtracter.
     Backgroundremoval(dirs, parameters)
     
     # Composite image aligner.
-    Composite_Aligner(channels, dirs, parameters)
+    canvas = Composite_Aligner(channels, dirs, parameters)
             
     # Raw image transformer (registration).
-    Transformer(channels, dirs)
+    Transformer(channels, dirs, parameters)
     
     # Composite image segmentation.
-    segmentation = Weka_Segm(dirs)
+    segmentation = Cell_Segm(dirs, parameters)
+
+    # Derives the crop rectangle for later runs from this segmentation.
+    auto_crop(parameters, canvas)
     
 
     
@@ -110,17 +241,23 @@ def main():
     # calls for plots, gifs and ratiometric image generation.
     if channels == 3:
         # Measurements and calculations.
-        raw_data = Measurements(channels, timelist, dirs, parameters)   
-        FRET_val, cFRET = three_cube(raw_data, LP)
+        dataset = Cell_Measurements(channels, timelist, dirs, parameters)   
+        FRET_val, cFRET, D_Conc = three_cube(dataset, LP, parameters)
 
         # Tabulator.
         results_table = []
         table = open(os.path.join(dirs["Tables"], "Resultstable.txt"), "w")
 
-        [[results_table.append([a, b, c, d, e, f])for a, b, c, d, e, f in zip(s1,s2,s3,s4,s5,s6)]
-                               for s1,s2,s3,s4,s5,s6 in zip(FRET_val["Raw"], cFRET, FRET_val["dFRET"], 
-                                   FRET_val["aFRET"], raw_data["Slices"], raw_data["Time"])
-                                ]
+        # Values are rounded here, on export only. Slice is the stack slice
+        # number as before: the rows of timepoint n (from 0) carry slice
+        # n + 1 of the measured stack, not the slices of timepoint n.
+        Raw, dFRET, aFRET = FRET_val["Raw"], FRET_val["dFRET"], FRET_val["aFRET"]
+        for timepoint, time in enumerate(dataset.time):
+            stack_slice = float(dataset.slices[timepoint])
+            for index in xrange(timepoint * dataset.cells, (timepoint + 1) * dataset.cells):
+                results_table.append([round(Raw[index], 3), int(cFRET[index]),
+                                      round(dFRET[index], 3), round(aFRET[index], 3),
+                                      stack_slice, time])
                                                         
         table.write("\t\t\t".join(map(str,["Raw", "cFRET", "dFRET", "aFRET", "Slice", "Time "])))
         table.write(("_")*128)
@@ -133,35 +270,23 @@ def main():
 
         # Plot FRET values from dict.
         for FRET_value_ID, FRET_value in FRET_val.iteritems():
-            plots(FRET_value, timelist, raw_data["Cell_num"],
-                  FRET_value_ID, Stim_List, dirs, parameters
-                  )
+            plots(FRET_value, dataset, FRET_value_ID, Stim_List, dirs, parameters)
     
         
         # This plot-call returns scale.
-        max_Y, min_Y = plots(FRET_val["Raw"], timelist, raw_data["Cell_num"],
-                             "Raw", Stim_List, dirs, parameters)
+        max_Y, min_Y = plots(FRET_val["Raw"], dataset, "Raw", Stim_List, dirs, parameters)
 
-        # Corrects donor concentration, plots concentrations.
-        IDD_list = [[IDD + CFRET for (IDD, CFRET) in zip(x, y)] 
-                   for (x, y) in zip(raw_data["IDD"], cFRET)]
-
-        plots(IDD_list, timelist, raw_data["Cell_num"],
-              "Donor concentration", Stim_List, dirs, parameters
-              )
-        plots(FRET_val["A_Conc"], timelist, raw_data["Cell_num"],
-              "Acceptor concentration", Stim_List, dirs, parameters
-              )
+        # Corrected donor concentration (IDD + cFRET), plots concentrations.
+        plots(D_Conc, dataset, "Donor concentration", Stim_List, dirs, parameters)
+        plots(FRET_val["A_Conc"], dataset, "Acceptor concentration", Stim_List, dirs, parameters)
 
     # Ratiometric/2-channel mode. Same as for 3ch with less calculations.
     elif channels == 2:
-        raw_data = Measurements(channels, timelist, dirs, parameters)
-        FRET_val = Ratiometric(raw_data, parameters)
+        dataset = Cell_Measurements(channels, timelist, dirs, parameters)
+        FRET_val = Ratiometric(dataset, parameters)
         
         for FRET_value_ID, FRET_value in FRET_val.iteritems():
-            plots(FRET_value, timelist, raw_data["Cell_num"],
-                  FRET_value_ID, Stim_List, dirs, parameters
-                  )
+            plots(FRET_value, dataset, FRET_value_ID, Stim_List, dirs, parameters)
     
     # Scale, ROI color coded overlay and gif animation.
     Overlayer(org_size, dirs)
@@ -177,73 +302,127 @@ def settings():
     """ Settings """
 
     # Calls potential config file to set defaults
-    # for settings dialog. Sets all defaults to 0
+    # for settings dialog. Uses the schema defaults
     # if no config file exists.
     con_path = os.path.join(str(Root), "FRET_params.cfg")
     if os.path.exists(con_path):
         dflt = config_read()
-        print type(dflt.get("b_sub", "Rolling ball"))
-        print (dflt.get("b_sub", "Rolling ball"))
-        print type(int(dflt.get("b_sub", "Rolling ball")))
-        print (dflt.get("b_sub", "Rolling ball"))
     else:
-        dflt = {}
+        dflt = typed_parameters({})
 
     feat_model_strings = ["Translation", "Rigid", 
-                          "Similarity", "Affine
+                          "Similarity", "Affine"
                           ]
     reg_model_strings = ["Translation", "Rigid",
                          "Similarity", "Affine",
                          "Elastic", "Least Squares"
                          ]
     b_sub_strings = ["Rolling Ball", "Manual Selection"]
+    b_engine_strings = ["Full resolution", "Downsampled"]
+    seg_engine_strings = ["Weka classifier", "Classical watershed"]
+    seg_method_strings = SEG_METHODS
+    norm_mode_strings = ["Mean of control series", "Mean of time window",
+                         "Median of control series"
+                         ]
+    proj_mode_strings = ["All series at once", "Series-at-a-time",
+                         "Fused plane streaming"
+                         ]
                          
     # Registration parameters dialog.
     gd = GenericDialog("Advanced Settings")
     gd.addMessage("REGISTRATION PARAMETERS") 
-    gd.addNumericField("Steps per scale octave: ", float(dflt.get("steps", 6)), 0, 7, "")
-    gd.addNumericField("Max Octave Size: ", float(dflt.get("max_oct", 1024)), 0, 7, "")
-    gd.addNumericField("Feature Descriptor Size: ", float(dflt.get("fd_size", 12)), 1, 7, "")
-    gd.addNumericField("Initial Sigma: ", float(dflt.get("sigma", 1.2)), 2, 7, "")  
-    gd.addNumericField("Max Epsilon: ", float(dflt.get("max_eps", 15)), 1, 7, "")
-    gd.addNumericField("Min Inlier Ratio: ", float(dflt.get("min_inlier", 0.05)), 3, 7, "")
-    gd.addCheckbox("Use Shrinkage Constraint", ast.literal_eval(dflt.get("shrinkage", "False")))
+    gd.addNumericField("Steps per scale octave: ", dflt["steps"], 0, 7, "")
+    gd.addNumericField("Max Octave Size: ", dflt["max_oct"], 0, 7, "")
+    gd.addNumericField("Feature Descriptor Size: ", dflt["fd_size"], 1, 7, "")
+    gd.addNumericField("Initial Sigma: ", dflt["sigma"], 2, 7, "")  
+    gd.addNumericField("Max Epsilon: ", dflt["max_eps"], 1, 7, "")
+    gd.addNumericField("Min Inlier Ratio: ", dflt["min_inlier"], 3, 7, "")
+    gd.addCheckbox("Use Shrinkage Constraint", dflt["shrinkage"])
     gd.addChoice("Feature extraction model", feat_model_strings,
-                 feat_model_strings[int(dflt.get("feat_model", 1))]
+                 feat_model_strings[dflt["feat_model"]]
                  )
     gd.addChoice("Registration model", reg_model_strings,
-                 reg_model_strings[int(dflt.get("reg_model", 1))]
+                 reg_model_strings[dflt["reg_model"]]
                  )
+    gd.addCheckbox("Phase correlation for Translation", dflt["phase_corr"])
+    gd.addCheckbox("Cached SIFT features (linear models)", dflt["reg_features"])
+    gd.addNumericField("Keyframe spacing (0 = to reference)", dflt["reg_chain"], 0, 7, "")
     
     # Background removal parameters dialog.
     gd.addPanel(Panel())
     gd.addMessage("BACKGROUND REMOVAL") 
     gd.addChoice("Subtraction method:", b_sub_strings,
-                 b_sub_strings[int(dflt.get("b_sub", 0))]
+                 b_sub_strings[dflt["b_sub"]]
                  )          
-    gd.addNumericField("Rolling ball size: ", 
-                       float(dflt.get("ballsize", 50)), 1, 7, "px"
-                       )
-    gd.addCheckbox("Create Background", ast.literal_eval(dflt.get("create_b", "False")))
-    gd.addCheckbox("Light Background", ast.literal_eval(dflt.get("light_b", "False")))
-    gd.addCheckbox("Use Parabaloid", ast.literal_eval(dflt.get("parab", "False")))
-    gd.addCheckbox("Do Pre-smoothing", ast.literal_eval(dflt.get("smooth", "False")))
-    gd.addCheckbox("Correct Corners", ast.literal_eval(dflt.get("corners", "False")))
+    gd.addNumericField("Rolling ball size: ", dflt["ballsize"], 1, 7, "px")
+    gd.addCheckbox("Create Background", dflt["create_b"])
+    gd.addCheckbox("Light Background", dflt["light_b"])
+    gd.addCheckbox("Use Parabaloid", dflt["parab"])
+    gd.addCheckbox("Do Pre-smoothing", dflt["smooth"])
+    gd.addCheckbox("Correct Corners", dflt["corners"])
+    gd.addChoice("Background engine", b_engine_strings,
+                 b_engine_strings[dflt["b_engine"]]
+                 )
+    gd.addNumericField("Downsampling factor", dflt["b_shrink"], 0, 7, "")
+    gd.addCheckbox("Reuse background between timepoints", dflt["b_reuse"])
+    gd.addNumericField("Reuse tolerance", dflt["b_reuse_tol"], 3, 7, "")
+
+    # Segmentation parameters dialog.
+    gd.addPanel(Panel())
+    gd.addMessage("SEGMENTATION PARAMETERS")
+    gd.addChoice("Segmentation engine", seg_engine_strings,
+                 seg_engine_strings[dflt["seg_engine"]]
+                 )
+    gd.addChoice("Threshold method (classical)", seg_method_strings,
+                 seg_method_strings[dflt["seg_method"]]
+                 )
+    gd.addNumericField("Pre-smoothing sigma (classical)", dflt["seg_smooth"], 1, 7, "px")
+    gd.addNumericField("Watershed erosion", dflt["ws_erosion"], 1, 7, "")
+    gd.addNumericField("Convexity threshold", dflt["ws_convexity"], 2, 7, "")
+    gd.addNumericField("Min separator size", dflt["ws_sep_min"], 0, 7, "px")
+    gd.addNumericField("Max separator size (0 = Infinity)", dflt["ws_sep_max"], 0, 7, "px")
+    gd.addNumericField("Classifier tile size (0 = off)", dflt["weka_tile"], 0, 7, "px")
+    gd.addNumericField("Classifier tile margin", dflt["weka_margin"], 0, 7, "px")
 
     # Measumrent parameters dialog.
     gd.addPanel(Panel())
     gd.addMessage("MEASUREMENT PARAMETERS")
-    gd.addNumericField("Max Cell Area", float(dflt.get("cell_max", 2200)), 0, 7, "px")
-    gd.addNumericField("Min Cell Area", float(dflt.get("cell_min", 200)), 0, 7, "px")
-    gd.addNumericField("Ratio Subtraction", float(dflt.get("subtr_ratio", 0.31)), 3, 7, "")
+    gd.addNumericField("Max Cell Area", dflt["cell_max"], 0, 7, "px")
+    gd.addNumericField("Min Cell Area", dflt["cell_min"], 0, 7, "px")
+    gd.addNumericField("Ratio Subtraction", dflt["subtr_ratio"], 3, 7, "")
 
     # Plot parameters dialog.
     gd.addPanel(Panel())
     gd.addMessage("PLOT PARAMETERS")
-    gd.addNumericField("Max y, d and aFRET", float(dflt.get("p_max", 0.65)), 2, 7, "")
-    gd.addNumericField("Min y, d and aFRET", float(dflt.get("p_min", 0.0)), 2, 7, "")
-    gd.addNumericField("Max y, norm. d and aFRET", float(dflt.get("p_max_n", 1.65)), 2, 7, "")
-    gd.addNumericField("Min y, norm. d and aFRET", float(dflt.get("p_min_n", 0.5)), 2, 7, "")
+    gd.addNumericField("Max y, d and aFRET", dflt["p_max"], 2, 7, "")
+    gd.addNumericField("Min y, d and aFRET", dflt["p_min"], 2, 7, "")
+    gd.addNumericField("Max y, norm. d and aFRET", dflt["p_max_n"], 2, 7, "")
+    gd.addNumericField("Min y, norm. d and aFRET", dflt["p_min_n"], 2, 7, "")
+
+    # Normalization parameters dialog.
+    gd.addPanel(Panel())
+    gd.addMessage("NORMALIZATION")
+    gd.addChoice("Baseline", norm_mode_strings,
+                 norm_mode_strings[dflt["norm_mode"]]
+                 )
+    gd.addNumericField("Baseline window start", dflt["norm_start"], 1, 7, "min")
+    gd.addNumericField("Baseline window end", dflt["norm_end"], 1, 7, "min")
+
+    # Processing parameters dialog.
+    gd.addPanel(Panel())
+    gd.addMessage("PROCESSING PARAMETERS")
+    gd.addChoice("Projection mode", proj_mode_strings,
+                 proj_mode_strings[dflt["proj_mode"]]
+                 )
+    gd.addNumericField("Worker threads", dflt["workers"], 0, 7, "")
+    gd.addMessage("Crop on read (width/height 0 = full frame)")
+    gd.addNumericField("Crop x", dflt["crop_x"], 0, 7, "px")
+    gd.addNumericField("Crop y", dflt["crop_y"], 0, 7, "px")
+    gd.addNumericField("Crop width", dflt["crop_w"], 0, 7, "px")
+    gd.addNumericField("Crop height", dflt["crop_h"], 0, 7, "px")
+    gd.addCheckbox("Auto crop from first segmentation", dflt["crop_auto"])
+    gd.addNumericField("Auto crop margin", dflt["crop_margin"], 0, 7, "px")
+    gd.addCheckbox("Memory-mapped aligned stack", dflt["aligned_raw"])
     
     # Set location of dialog on screen.
     #gd.setLocation(0,1000)
@@ -264,6 +443,9 @@ def settings():
                  "shrinkage" : gd.getNextBoolean(),
                  "feat_model" : gd.getNextChoiceIndex(),
                  "reg_model" : gd.getNextChoiceIndex(),
+                 "phase_corr" : gd.getNextBoolean(),
+                 "reg_features" : gd.getNextBoolean(),
+                 "reg_chain" : gd.getNextNumber(),
                  "b_sub" : gd.getNextChoiceIndex(),
                  "ballsize" : gd.getNextNumber(),
                  "create_b" : gd.getNextBoolean(),
@@ -271,27 +453,52 @@ def settings():
                  "parab" : gd.getNextBoolean(),
                  "smooth" : gd.getNextBoolean(),
                  "corners" : gd.getNextBoolean(),
+                 "b_engine" : gd.getNextChoiceIndex(),
+                 "b_shrink" : gd.getNextNumber(),
+                 "b_reuse" : gd.getNextBoolean(),
+                 "b_reuse_tol" : gd.getNextNumber(),
+                 "seg_engine" : gd.getNextChoiceIndex(),
+                 "seg_method" : gd.getNextChoiceIndex(),
+                 "seg_smooth" : gd.getNextNumber(),
+                 "ws_erosion" : gd.getNextNumber(),
+                 "ws_convexity" : gd.getNextNumber(),
+                 "ws_sep_min" : gd.getNextNumber(),
+                 "ws_sep_max" : gd.getNextNumber(),
+                 "weka_tile" : gd.getNextNumber(),
+                 "weka_margin" : gd.getNextNumber(),
                  "cell_max" : gd.getNextNumber(),
                  "cell_min" : gd.getNextNumber(),
                  "subtr_ratio" : gd.getNextNumber(),
                  "p_max" : gd.getNextNumber(),
                  "p_min" : gd.getNextNumber(),
                  "p_max_n" : gd.getNextNumber(),
-                 "p_min_n" : gd.getNextNumber()
+                 "p_min_n" : gd.getNextNumber(),
+                 "norm_mode" : gd.getNextChoiceIndex(),
+                 "norm_start" : gd.getNextNumber(),
+                 "norm_end" : gd.getNextNumber(),
+                 "proj_mode" : gd.getNextChoiceIndex(),
+                 "workers" : gd.getNextNumber(),
+                 "crop_x" : gd.getNextNumber(),
+                 "crop_y" : gd.getNextNumber(),
+                 "crop_w" : gd.getNextNumber(),
+                 "crop_h" : gd.getNextNumber(),
+                 "crop_auto" : gd.getNextBoolean(),
+                 "crop_margin" : gd.getNextNumber(),
+                 "aligned_raw" : gd.getNextBoolean()
                  }
 
-    parameters = config_write(parameters)   
+    parameters = config_write(typed_parameters(parameters))
 
     return parameters
 
 def config_write(parameters):
+    """ Writes typed parameters to the config file, in schema order. """
     
     config = ConfigParser.RawConfigParser()
     config.add_section("Parameters")
 
-    
-    for key, value in parameters.iteritems():
-        config.set("Parameters", str(key), str(value))
+    for key in PARAMS:
+        config.set("Parameters", key, str(parameters[key]))
 
     with open(os.path.join(str(Root), "FRET_params.cfg"), "wb") as configfile:
         config.write(configfile)
@@ -300,7 +507,7 @@ def config_write(parameters):
 
 
 def config_read():
-    """ Config file reader, returns parameters from config file. """
+    """ Config file reader, returns typed parameters from config file. """
 
     # Launch parser, set path to cfg file.
     config = ConfigParser.RawConfigParser()
@@ -322,10 +529,8 @@ def config_read():
                    )
             raise
 
-        # Build dict. of parameters.
-        parameters = {}
-        for key, value in p_list:
-            parameters[key] = value
+        # Typed dict. of parameters, missing keys get schema defaults.
+        parameters = typed_parameters(dict(p_list))
 
     else:
         print ("ERROR: Config file not found, check " + str(con_path) + " "
@@ -338,51 +543,86 @@ def config_read():
     
     return parameters
 
-def meta_parser():
-    """ Iterates through .lif XML/OME metadata, returns selected values eg. timepoints, channels, series count, laser power.. """
 
-    # Get metadata.
-    reader = ImageReader()
-    omeMeta = MetadataTools.createOMEXMLMetadata()
-    reader.setMetadataStore(omeMeta)
-    reader.setId(str(Experiment))
+def parse_parameter(key, value):
+    """ Converts a config string or dialog value to the schema type,
+        raises ValueError if it is malformed or out of range. """
+
+    kind, default, minimum, maximum = PARAMS[key]
+
+    if kind is bool:
+        if str(value) not in ("True", "False"):
+            raise ValueError("Parameter '" + key + "' must be True or False, got "
+                             + str(value))
+        return str(value) == "True"
+
+    try:
+        # Dialog numbers (and old configs) give floats for int fields.
+        if kind is int:
+            value = int(round(float(value)))
+        else:
+            value = float(value)
+    except ValueError:
+        raise ValueError("Parameter '" + key + "' must be a number, got "
+                         + str(value))
+
+    if ((minimum is not None and value < minimum) 
+            or (maximum is not None and value > maximum)):
+        raise ValueError("Parameter '" + key + "' = " + str(value) 
+                         + " outside [" + str(minimum) + ", " + str(maximum) + "]")
+
+    return value
+
+
+def typed_parameters(raw):
+    """ Typed, validated parameters for every schema key, 
+        keys missing from raw get their default. """
+
+    parameters = {}
+    for key in PARAMS:
+        parameters[key] = parse_parameter(key, raw.get(key, PARAMS[key][1]))
+
+    return parameters
+
+
+def parameter_hash(parameters, keys=None):
+    """ Content hash of the parameters (or of a subset of keys), 
+        for keying caches of stage results. """
+
+    keys = sorted(keys or PARAMS.keys())
+    content = ";".join(key + "=" + repr(parameters[key]) for key in keys)
+    return hashlib.sha1(content).hexdigest()
+
+
+def meta_parser(parameters):
+    """ Returns selected .lif XML/OME metadata values eg. timepoints, channels, series count, laser power.. """
+
+    # Cached metadata, shared with Timepoints.py (see lif_metadata.py).
+    meta = lif_metadata.read_metadata(str(Experiment))
 
     # Extracts number of image series, channel number
-    seriesCount = reader.getSeriesCount()
-    channels = reader.getSizeC()
-    #reader.close()
+    seriesCount = meta["series_count"]
+    channels = meta["channels"]
 
     # Number of images
-    imageCount = omeMeta.getImageCount()
-
-    # Image size in pixels AND microns (for scalebar).
-    Physical_x = omeMeta.getPixelsPhysicalSizeX(0)
-    Pixel_x = omeMeta.getPixelsSizeX(0)
-    Physical_x = Physical_x.value()
-    Pixel_x = Pixel_x.getNumberValue()
+    imageCount = meta["image_count"]
 
-    # Assumes square image (x=y).
-    org_size = (Physical_x*Pixel_x)*2
+    # Image size in pixels AND microns (for scalebar), 
+    # width + height of the field that is read.
+    region = crop_region(parameters, meta)
+    if region is None:
+        org_size = meta["physical_x"]*(meta["pixel_x"] + meta["pixel_y"])
+    else:
+        org_size = meta["physical_x"]*(region.width + region.height)
 
     # Laser power of donor excitation laser.
     if channels == 3:
-        LP = omeMeta.getChannelLightSourceSettingsAttenuation(0,0)
-        LP = 1 - LP.getNumberValue()
+        LP = 1 - meta["attenuation"]
     else:
         LP = 0
 
-
-
-    timelist = []
-    for timepoint in range (imageCount):
-        times = omeMeta.getImageAcquisitionDate(timepoint)
-        timelist.append(times.toString())
-	
-	
     # YY.MM... to minutes.
-    timelist =[ time.mktime(time.strptime(times, u'%Y-%m-%dT%H:%M:%S')) for times in timelist ]
-    timelist_unsorted =[ (times - timelist[0])/60 for times in timelist ]
-
+    timelist_unsorted = lif_metadata.acquisition_minutes(meta)
     timelist = sorted(timelist_unsorted)
 
     # Prints to log.
@@ -394,6 +634,55 @@ def meta_parser():
 
 
 
+def crop_region(parameters, meta):
+    """ Field of view to read as a loci Region clamped to the frame,
+        None (full frames) if crop width or height is 0. """
+
+    width, height = parameters["crop_w"], parameters["crop_h"]
+    if width <= 0 or height <= 0:
+        return None
+
+    x = min(parameters["crop_x"], meta["pixel_x"] - 1)
+    y = min(parameters["crop_y"], meta["pixel_y"] - 1)
+    return Region(x, y, min(width, meta["pixel_x"] - x), min(height, meta["pixel_y"] - y))
+
+
+def auto_crop(parameters, canvas):
+    """ Sets the crop rectangle to the bounds of the segmented cells plus
+        a margin and writes it to the config, so the next runs read only
+        that field. Runs once, a crop that is already set is kept. canvas
+        is the aligned image canvas in (uncropped) reference coordinates. """
+
+    if not parameters["crop_auto"] or parameters["crop_w"] > 0:
+        return
+
+    rm = RoiManager.getInstance()
+    if rm is None or rm.getCount() == 0:
+        return
+
+    bounds = rm.getRoi(0).getBounds()
+    for roi in rm.getRoisAsArray():
+        bounds.add(roi.getBounds())
+
+    # Aligned canvas to raw reference frame coordinates, the margin
+    # absorbs the drift of the other timepoints. Clamped to the frame.
+    meta = lif_metadata.read_metadata(str(Experiment))
+    margin = parameters["crop_margin"]
+    left, top = bounds.x + canvas.x, bounds.y + canvas.y
+    x, y = max(left - margin, 0), max(top - margin, 0)
+    right = min(left + bounds.width + margin, meta["pixel_x"])
+    bottom = min(top + bounds.height + margin, meta["pixel_y"])
+    if right <= x or bottom <= y:
+        IJ.log("Auto crop skipped, cells lie outside the raw frame.")
+        return
+    parameters["crop_x"], parameters["crop_y"] = x, y
+    parameters["crop_w"], parameters["crop_h"] = right - x, bottom - y
+    config_write(parameters)
+
+    IJ.log("Crop for next runs: x=%d y=%d w=%d h=%d" % (x, y, 
+           parameters["crop_w"], parameters["crop_h"]))
+
+
 def directorator(Title, Root):
     """ Creates all required directories, adds (#) if experiment """
     """ replicates exist, returns dict of directory paths.      """
@@ -413,7 +702,7 @@ def directorator(Title, Root):
     os.makedirs(Exp_root)
 
     subdirs = [
-        "Plots", "Tables", "Projections",
+        "Plots", "Tables",
         "Projections_C0", "Projections_C1",
         "Projections_C2", "Composites",
         "Composites_Aligned", "Transformations",
@@ -429,9 +718,32 @@ def directorator(Title, Root):
     return dirs
 
     
-def imageprojector(channels, timelist_unsorted, dirs):
+def imageprojector(channels, timelist_unsorted, dirs, parameters):
 	""" Projects .lif timepoints and saves in a common directory,
 	    as well as channel separated directories. """
+
+	# 0 = all series at once, 1 = series-at-a-time, 2 = fused plane streaming.
+	proj_mode = parameters["proj_mode"]
+
+	# Optional field of view, applied by the reader.
+	region = crop_region(parameters, lif_metadata.read_metadata(str(Experiment)))
+	if region is not None:
+		IJ.log("Reading crop: x=%d y=%d w=%d h=%d"
+		       % (region.x, region.y, region.width, region.height))
+
+	if proj_mode == 2:
+		fused_projector(timelist_unsorted, dirs, parameters["workers"], region)
+	elif proj_mode == 1:
+		series_projector(timelist_unsorted, dirs, region)
+	else:
+		bulk_projector(channels, timelist_unsorted, dirs, region)
+
+	IJ.log("Images projected and saved to disk")
+
+
+def bulk_projector(channels, timelist_unsorted, dirs, region=None):
+	""" Opens every series with the BF importer, then projects them.
+	    Holds the whole experiment in memory. """
 	
 	# Defines in path
 	path = str(Experiment)
@@ -441,169 +753,924 @@ def imageprojector(channels, timelist_unsorted, dirs):
 	
 	try:
 		options.setId(path)
-	except Exception(e):
+	except Exception, e:
 		print str(e)
 		
 	options.setOpenAllSeries(True)
 	options.setSplitTimepoints(True)
 	options.setSplitChannels(True)
+	if region is not None:
+		options.setCropOn(True)
+		for series in range(len(timelist_unsorted)):
+			options.setCropRegion(series, region)
 	imps = BF.openImagePlus(options)
 
 	timelist = [x for item in timelist_unsorted for x in repeat(item, channels)]
 	timelist, imps = zip(*sorted(zip(timelist, imps)))
 
-	
-	counter_C0 = -1
-	counter_C1 = -1
-	counter_C2 = -1
-	# Opens all images, splits channels, z-projects and saves to disk
-	for imp in (imps):
-		# Projection, Sum Intensity
-   		project = ZProjector()
-		project.setMethod(ZProjector.SUM_METHOD)
-		project.setImage(imp)
-		project.doProjection()
-		impout = project.getProjection()
+	# Opens all images, splits channels, z-projects and saves to disk.
+	counters = [-1] * channels
+	projected = {}
+	for imp in imps:
+		impout = sum_projection(imp)
 		projection = impout.getTitle()
+	
+		for channel in range(channels):
+			if "C=" + str(channel) in projection:
+				counters[channel] += 1
+				save_projection(impout, dirs, counters[channel], channel)
+				projected.setdefault(counters[channel], {})[channel] = impout.getProcessor()
 
-		try:
-			# Saves channels to disk, 
-			# add more channels here if desired, 
-			# remember to define new counters.
-			if "C=0" in projection:
-				counter_C0 += 1
-				IJ.saveAs(impout, "TIFF", os.path.join(dirs["Projections"],
-				          "Scan" + str(counter_C0).zfill(3) + "C0"))
-                
-				IJ.saveAs(impout, "TIFF", os.path.join(dirs["Projections_C0"],
-				          "Scan" + str(counter_C0).zfill(3) + "C0"))		
-			
-			elif "C=1" in projection:
-				counter_C1 += 1
-				IJ.saveAs(impout, "TIFF", os.path.join(dirs["Projections"],
-				          "Scan" + str(counter_C1).zfill(3) + "C1"))
-                         
-				IJ.saveAs(impout, "TIFF", os.path.join(dirs["Projections_C1"],
-				          "Scan" + str(counter_C1).zfill(3) + "C1"))
+	for scan, processors in sorted(projected.items()):
+		Compositor(scan, [processors[channel] for channel in sorted(processors)], dirs)
 
-			elif "C=2" in projection:
-				counter_C2 += 1
-				IJ.saveAs(impout, "TIFF", os.path.join(dirs["Projections"],
-				          "Scan" + str(counter_C2).zfill(3) + "C2"))
-                         
-				IJ.saveAs(impout, "TIFF", os.path.join(dirs["Projections_C2"],
-				          "Scan" + str(counter_C2).zfill(3) + "C2"))
-		
-		except IOException:
-			print "Directory does not exist"
-			raise
 
-	IJ.log("Images projected and saved to disk")
+def series_projector(timelist_unsorted, dirs, region=None):
+    """ Projects one series/channel at a time from a single reader,
+        peak memory is one z-stack regardless of the number of timepoints. """
 
-	
+    # One reader (one metadata parse) for the whole experiment.
+    reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+    reader.setId(str(Experiment))
+
+    # Scan numbers follow acquisition time, not series order.
+    order = sorted(range(len(timelist_unsorted)),
+                   key=lambda series: timelist_unsorted[series])
+
+    try:
+        for scan, series in enumerate(order):
+            reader.setSeries(series)
+            field = region or Region(0, 0, reader.getSizeX(), reader.getSizeY())
+            impouts = []
+            for channel in range(reader.getSizeC()):
+                stack = ImageStack(field.width, field.height)
+                for z in range(reader.getSizeZ()):
+                    index = reader.getIndex(z, channel, 0)
+                    stack.addSlice(reader.openProcessors(index, field.x, field.y,
+                                                         field.width, field.height)[0])
+
+                imp = ImagePlus("Scan" + str(scan).zfill(3), stack)
+                impout = sum_projection(imp)
+                save_projection(impout, dirs, scan, channel)
+                impouts.append(impout)
+
+                # Releases the stack before the next channel is read.
+                imp.flush()
+
+            Compositor(scan, [impout.getProcessor() for impout in impouts], dirs)
+            for impout in impouts:
+                impout.flush()
+    finally:
+        reader.close()
+
+
+def fused_projector(timelist_unsorted, dirs, workers, region=None):
+    """ Projects while reading: every z-plane is added to a 32-bit sum
+        as soon as it is decoded, a z-stack is never held in memory.
+        Series are spread over a pool of workers with one reader each. """
+
+    path = str(Experiment)
+
+    # Parses the file once, the memo lets the workers' readers skip it.
+    primer = Memoizer(ImageReader())
+    primer.setId(path)
+    primer.close()
+
+    # Scan numbers follow acquisition time, not series order,
+    # so output names do not depend on which worker finishes first.
+    order = sorted(range(len(timelist_unsorted)),
+                   key=lambda series: timelist_unsorted[series])
+
+    def setup():
+        reader = Memoizer(ImageReader())
+        reader.setId(path)
+        # Decodes the next plane while the current one is accumulated.
+        return reader, Executors.newSingleThreadExecutor()
+
+    def project(state, task):
+        reader, decoder = state
+        scan, series = task
+        reader.setSeries(series)
+        processors = []
+        for channel in range(reader.getSizeC()):
+            processors.append(fused_sum(reader, channel, decoder, region))
+            save_projection(ImagePlus("Scan" + str(scan).zfill(3), processors[-1]),
+                            dirs, scan, channel)
+
+        # Composites are built per timepoint on the same worker.
+        Compositor(scan, processors, dirs)
+
+    def teardown(state):
+        reader, decoder = state
+        decoder.shutdown()
+        reader.close()
+
+    worker_pool(list(enumerate(order)), project, workers, setup, teardown)
+
+
+def fused_sum(reader, channel, decoder, region=None):
+    """ Sum projection of one channel of the reader's current series,
+        over the whole frame or only the crop region. """
+
+    field = region or Region(0, 0, reader.getSizeX(), reader.getSizeY())
+    sizeZ = reader.getSizeZ()
+    accumulator = FloatProcessor(field.width, field.height)
+
+    pending = decoder.submit(PlaneDecoder(reader, reader.getIndex(0, channel, 0), field))
+    for z in range(sizeZ):
+        plane = pending.get()
+        if z + 1 < sizeZ:
+            pending = decoder.submit(PlaneDecoder(reader, reader.getIndex(z + 1, channel, 0), field))
+        accumulator.copyBits(plane.convertToFloat(), 0, 0, Blitter.ADD)
+
+    return accumulator
+
+
+class PlaneDecoder(Callable):
+    """ Reads one plane (field) with openBytes and wraps it as an ImageProcessor. """
+
+    def __init__(self, reader, index, field):
+        self.reader = reader
+        self.index = index
+        self.field = field
+
+    def call(self):
+        reader, field = self.reader, self.field
+        width, height = field.width, field.height
+        pixel_type = reader.getPixelType()
+        bpp = FormatTools.getBytesPerPixel(pixel_type)
+        plane = reader.openBytes(self.index, field.x, field.y, width, height)
+        pixels = DataTools.makeDataArray(plane, bpp,
+                                         FormatTools.isFloatingPoint(pixel_type),
+                                         reader.isLittleEndian())
+        if bpp == 1:
+            return ByteProcessor(width, height, pixels, None)
+        elif bpp == 2:
+            return ShortProcessor(width, height, pixels, None)
+        else:
+            # 32-bit int/float and 64-bit float planes.
+            return FloatProcessor(width, height, pixels)
+
+
+def sum_projection(imp):
+    """ Sum intensity z-projection of a stack. """
+
+    project = ZProjector()
+    project.setMethod(ZProjector.SUM_METHOD)
+    project.setImage(imp)
+    project.doProjection()
+    return project.getProjection()
+
+
+def save_projection(impout, dirs, scan, channel):
+    """ Saves a projection once, to the projection store. """
+
+    # FileSaver rather than IJ.saveAs, projections are saved from worker threads.
+    path = projection_path(dirs, scan, channel)
+    if not FileSaver(impout).saveAsTiff(path):
+        raise IOError("Could not save " + path)
+
+
+def projection_path(dirs, scan, channel):
+    """ Projection store: every plane is written once, as Projections_C#/Scan###C#.tif.
+        The channel directories double as RVSS source directories. """
+
+    return os.path.join(dirs["Projections_C" + str(channel)],
+                        "Scan" + str(scan).zfill(3) + "C" + str(channel) + ".tif")
+
+
+def channel_projections(dirs, channel):
+    """ Store view by channel, paths of all timepoints in scan order. """
+
+    directory = dirs["Projections_C" + str(channel)]
+    return [os.path.join(directory, filename)
+            for filename in sorted(os.listdir(directory))
+            if filename.endswith(".tif")]
+
+
+def timepoint_projections(dirs, scan, channels):
+    """ Store view by timepoint, paths of all channels of one scan. """
+
+    return [projection_path(dirs, scan, channel) for channel in range(channels)]
+
+
+def worker_pool(task_list, work, workers, setup=None, teardown=None):
+    """ Runs work(state, task) for every task on a pool of threads, returns
+        the results in task order. setup() builds the state each worker
+        owns (readers, subtracters..), teardown(state) releases it.
+        Tasks are fed through a bounded queue, the first error is re-raised. """
+
+    workers = max(1, int(workers))
+    tasks = Queue.Queue(maxsize=2*workers)
+    results, errors = {}, []
+    stop = object()
+
+    def run():
+        state = None
+        try:
+            if setup is not None:
+                state = setup()
+        except:
+            errors.append(sys.exc_info())
+
+        while True:
+            item = tasks.get()
+            if item is stop:
+                break
+            # Drains the queue without working once a worker has failed.
+            if errors:
+                continue
+            index, task = item
+            try:
+                results[index] = work(state, task)
+            except:
+                errors.append(sys.exc_info())
+
+        if teardown is not None and state is not None:
+            teardown(state)
+
+    threads = [threading.Thread(target=run) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    task_list = list(task_list)
+    for item in enumerate(task_list):
+        tasks.put(item)
+    for thread in threads:
+        tasks.put(stop)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return [results[index] for index in range(len(task_list))]
+
+    
 def Composite_Aligner(channels, dirs, parameters):
-    """ Aligns composite images, saves to directory. """
-		
+    """ Aligns composite images, saves to directory. Transforms are cached
+        per timepoint, registration only runs for new or changed composites.
+        Returns the aligned canvas (rectangle in reference coordinates). """
+
     # Reference image name (must be within source directory)	
     reference_name = "Timepoint000.tif"
+    composites = sorted(filename for filename in os.listdir(dirs["Composites"])
+                        if filename.endswith(".tif"))
+
+    # Cache key of a timepoint: registration parameters, reference and composite.
+    reg_keys = ["steps", "max_oct", "fd_size", "sigma", "max_eps",
+                "min_inlier", "shrinkage", "feat_model", "reg_model",
+                "phase_corr", "reg_features", "reg_chain"]
+    prefix = (parameter_hash(parameters, reg_keys)
+              + file_hash(os.path.join(dirs["Composites"], reference_name)))
+
+    # Chained timepoints also depend on the key of their anchor frame.
+    # RVSS registers each slice to its neighbour, there every timepoint
+    # depends on all frames before it.
+    rvss = not (use_phase_correlation(parameters) or use_feature_engine(parameters))
+    chained = use_feature_engine(parameters) and parameters["reg_chain"] > 0
+
+    cache = cache_dir("registration")
+    keys, stale = {}, []
+    for index, name in enumerate(composites):
+        if rvss:
+            anchor = index - 1 if index > 0 else None
+        else:
+            anchor = registration_anchor(index, parameters["reg_chain"])
+        depends = keys[composites[anchor]] if (rvss or chained) and anchor is not None else ""
+        keys[name] = hashlib.sha1(
+            prefix + file_hash(os.path.join(dirs["Composites"], name))
+            + depends).hexdigest()
+        if not os.path.exists(os.path.join(cache, keys[name] + ".xml")):
+            stale.append(name)
+
+    # RVSS chains through the frames it is given, a partial sequence
+    # would not match a fresh run, so it always registers all of them.
+    if rvss and stale:
+        stale = list(composites)
+
+    print ("Registration: " + str(len(composites) - len(stale)) + " cached, "
+           + str(len(stale)) + " to register")
+    if stale and use_phase_correlation(parameters):
+        phase_correlate_composites(stale, reference_name, keys, dirs, parameters, cache)
+    elif stale and use_feature_engine(parameters):
+        feature_register_composites(stale, composites, keys, dirs, parameters, cache)
+    elif stale:
+        register_composites(stale, reference_name, keys, dirs, parameters, cache)
+
+    # Transforms of all timepoints, as RVSS would have written them.
+    for name in composites:
+        shutil.copyfile(os.path.join(cache, keys[name] + ".xml"),
+                        os.path.join(dirs["Transformations"], 
+                                     os.path.splitext(name)[0] + ".xml"))
+
+    # Renders the aligned composites from the transforms, on the same
+    # common canvas Transformer() uses for the raw projections.
+    canvas = transform_images([(os.path.join(dirs["Transformations"], 
+                                             os.path.splitext(name)[0] + ".xml"),
+                                [os.path.join(dirs["Composites"], name)])
+                               for name in composites],
+                              dirs["Composites_Aligned"], parameters["workers"])
+
+    print ("Registration completed.")
+    return canvas
+
+
+def register_composites(names, reference_name, keys, dirs, parameters, cache):
+    """ Registers the given composites (plus the reference) with RVSS in a
+        staging directory and stores their transforms in the cache. """
 		
     # Shrinkage option (False = 0)
-    if parameters["shrinkage"] == "True":
+    if parameters["shrinkage"]:
         use_shrinking_constraint = 1
-        print "shrink"
     else:
         use_shrinking_constraint = 0
-        print "noshrink"
 
     # Parameters method, RVSS
     p = Register_Virtual_Stack_MT.Param()
 		
-    # SIFT parameters:
-    # python cannot coerce string "floats" to int directly,
-    # hence int(float("1.0")) (RVSS wants ints..).
-    p.sift.maxOctaveSize = int(float(parameters["max_oct"]))
-    p.sift.fdSize = int(float(parameters["fd_size"]))
-    p.sift.initialSigma = int(float(parameters["sigma"]))
-    p.maxEpsilon = int(float(parameters["max_eps"]))
-    p.sift.steps = int(float(parameters["steps"]))
-    p.minInlierRatio = int(float(parameters["min_inlier"]))
+    # SIFT parameters (typed by the parameter schema).
+    p.sift.maxOctaveSize = parameters["max_oct"]
+    p.sift.fdSize = parameters["fd_size"]
+    p.sift.initialSigma = parameters["sigma"]
+    p.maxEpsilon = parameters["max_eps"]
+    p.sift.steps = parameters["steps"]
+    p.minInlierRatio = parameters["min_inlier"]
 	
     # 1 = RIGID, 3 = AFFINE
-    p.featuresModelIndex = int(float(parameters["feat_model"]))
-    p.registrationModelIndex = int(float(parameters["reg_model"]))
+    p.featuresModelIndex = parameters["feat_model"]
+    p.registrationModelIndex = parameters["reg_model"]
 
     # Opens a dialog to set transformation options, comment out to run in default mode
     #IJ.beep()
     #p.showDialog()	
 
+    # Staging source holds the reference and the composites to register.
+    staging = tempfile.mkdtemp(prefix="registration_", dir=cache)
+    source, target, transf = [os.path.join(staging, Dest) 
+                              for Dest in ("Source", "Target", "Transformations")]
+    for Dest in (source, target, transf):
+        os.makedirs(Dest)
+    for name in set(names + [reference_name]):
+        shutil.copyfile(os.path.join(dirs["Composites"], name), 
+                        os.path.join(source, name))
+
     # Executes alignment.
     print ("Registering stack...")
-	
-    reference_name = "Timepoint000.tif"
-    Register_Virtual_Stack_MT.exec(dirs["Composites"] + os.sep, 
-	                               dirs["Composites_Aligned"] + os.sep,
-	                               dirs["Transformations"] + os.sep,
-	                               reference_name, p, use_shrinking_constraint)
+    try:
+        Register_Virtual_Stack_MT.exec(source + os.sep, target + os.sep,
+                                       transf + os.sep, reference_name, 
+                                       p, use_shrinking_constraint)
 
-    print ("Registration completed.")
-    # Close alignment window.
-    imp = WindowManager.getCurrentImage()
+        # Close alignment window.
+        imp = WindowManager.getCurrentImage()
+        if imp is not None:
+            imp.close()
+
+        for name in names:
+            xml = os.path.join(transf, os.path.splitext(name)[0] + ".xml")
+            if not os.path.exists(xml):
+                raise IOError("Registration wrote no transform for " + name)
+            shutil.copyfile(xml, os.path.join(cache, keys[name] + ".xml"))
+    finally:
+        shutil.rmtree(staging, True)
+
+
+def use_feature_engine(parameters):
+    """ Linear models without the shrinkage constraint are registered from
+        cached SIFT features if enabled in the settings, everything else
+        (and the default) by RVSS. """
+
+    return (parameters["reg_features"] and parameters["reg_model"] <= 3
+            and not parameters["shrinkage"])
+
+
+def registration_anchor(index, step):
+    """ Index of the frame a timepoint is registered to, None for the
+        reference. Without a keyframe step that is the reference, else
+        keyframes (every step'th frame) chain to the previous keyframe
+        and the frames in between to their keyframe. """
+
+    if index == 0:
+        return None
+    if step <= 0:
+        return 0
+    if index % step == 0:
+        return index - step
+    return index - index % step
+
+
+def feature_register_composites(names, composites, keys, dirs, parameters, cache):
+    """ Registers the given composites from SIFT features, which are cached
+        per image, and stores their transforms in the cache. Chained
+        transforms are composed from the anchor frame's transform. """
+
+    step = parameters["reg_chain"]
+    feature_cache = cache_dir("features")
+    index = dict((name, i) for i, name in enumerate(composites))
+    anchors = dict((name, registration_anchor(index[name], step)) for name in names)
+
+    # Features of the frames to register and of the frames they match to.
+    needed = set(names)
+    for name in names:
+        if anchors[name] is not None:
+            needed.add(composites[anchors[name]])
+    needed = sorted(needed)
+
+    def setup():
+        return SIFT(FloatArray2DSIFT(sift_param(parameters)))
+
+    def extract(sift, name):
+        return sift_features(os.path.join(dirs["Composites"], name), sift,
+                             parameters, feature_cache)
+
+    print ("Extracting features of " + str(len(needed)) + " composites...")
+    features = dict(zip(needed, worker_pool(needed, extract, parameters["workers"], setup)))
+
+    def match(state, name):
+        if anchors[name] is None:
+            return AffineTransform()
+        return match_features(features[name], features[composites[anchors[name]]],
+                              parameters, name)
+
+    pairwise = dict(zip(names, worker_pool(names, match, parameters["workers"])))
+
+    # Maps frame -> anchor -> ... -> reference, in time order so anchors
+    # registered in this run are composed before the frames using them.
+    transforms = {}
+    for name in sorted(names, key=index.get):
+        affine = AffineTransform()
+        if anchors[name] is not None:
+            anchor = composites[anchors[name]]
+            if anchor not in transforms:
+                xml = os.path.join(cache, keys[anchor] + ".xml")
+                transforms[anchor] = (Transform_Virtual_Stack_MT
+                                      .readCoordinateTransform(xml).createAffine())
+            affine = AffineTransform(transforms[anchor])
+        affine.concatenate(pairwise[name])
+        transforms[name] = affine
+
+        model = AffineModel2D()
+        model.set(affine)
+        with open(os.path.join(cache, keys[name] + ".xml"), "w") as xmlfile:
+            xmlfile.write(model.toXML(""))
+
+
+def sift_param(parameters):
+    """ SIFT parameters from the settings, other values as in RVSS. """
+
+    param = FloatArray2DSIFT.Param()
+    param.steps = parameters["steps"]
+    param.maxOctaveSize = parameters["max_oct"]
+    param.fdSize = parameters["fd_size"]
+    param.initialSigma = parameters["sigma"]
+    return param
+
+
+def sift_features(path, sift, parameters, cache):
+    """ SIFT features of an image, read from the feature cache if the
+        image and the SIFT parameters are unchanged. """
+
+    key = hashlib.sha1(parameter_hash(parameters, ["steps", "max_oct", "fd_size", "sigma"])
+                       + file_hash(path)).hexdigest()
+    cached = os.path.join(cache, key + ".ser")
+
+    if os.path.exists(cached):
+        try:
+            stream = ObjectInputStream(FileInputStream(cached))
+            try:
+                return stream.readObject()
+            finally:
+                stream.close()
+        except (IOException, ClassNotFoundException), e:
+            # Truncated, or written by another mpicbg version: extracted again.
+            print ("Unreadable feature cache for " + os.path.basename(path)
+                   + " (" + str(e) + "), extracting again.")
+            os.remove(cached)
+
+    features = ArrayList()
+    imp = IJ.openImage(path)
+    sift.extractFeatures(imp.getProcessor(), features)
     imp.close()
 
-def Transformer(channels, dirs):
-    """ Applies transformation matrices from Composite_Aligner to all raw, 32-bit projections. """
+    # Written under a temporary name, readers never see a partial file.
+    partial = cached + "." + threading.current_thread().getName()
+    stream = ObjectOutputStream(FileOutputStream(partial))
+    try:
+        stream.writeObject(features)
+    finally:
+        stream.close()
+    os.rename(partial, cached)
 
-    # Executes transformations for each channel.
-    t = register_virtual_stack.Transform_Virtual_Stack_MT
+    return features
 
-    print "Transforming channel 0..."
-    t.exec(dirs["Projections_C0"] + os.sep,
-	       dirs["Aligned_All"] + os.sep,
-	       dirs["Transformations"] + os.sep,
-	       True)
 
-    print "Channel 0 transformed."
-    imp = WindowManager.getCurrentImage()
-    imp.close()
+def linear_model(index):
+    """ Translation, Rigid, Similarity or Affine model by settings index. """
 
-    print "Transforming channel 1..."
-    t.exec(dirs["Projections_C1"] + os.sep,
-	       dirs["Aligned_All"] + os.sep, 
-	       dirs["Transformations"] + os.sep, 
-	       True)
+    return [TranslationModel2D, RigidModel2D, SimilarityModel2D, AffineModel2D][index]()
 
-    print "Channel 1 transformed."
-    imp = WindowManager.getCurrentImage()
-    imp.close()
 
+def match_features(features, anchor_features, parameters, name):
+    """ Affine transform from a frame to its anchor frame. Candidates are
+        filtered by RANSAC with the feature model, the registration model
+        is fitted to the inliers. Unmatched frames keep their position. """
 
-    if channels == 3:
-        print "Transforming channel 2..."
-        t.exec(dirs["Projections_C2"] + os.sep,
-		       dirs["Aligned_All"] + os.sep,
-		       dirs["Transformations"] + os.sep, 
-		       True)
+    # Closest/next closest ratio, RVSS default.
+    candidates, inliers = ArrayList(), ArrayList()
+    FeatureTransform.matchFeatures(features, anchor_features, candidates, 0.92)
 
-        print "Channel 2 transformed."
-        imp = WindowManager.getCurrentImage()
+    model = linear_model(parameters["feat_model"])
+    try:
+        found = model.filterRansac(candidates, inliers, 1000,
+                                   parameters["max_eps"], parameters["min_inlier"])
+        if found and parameters["reg_model"] != parameters["feat_model"]:
+            model = linear_model(parameters["reg_model"])
+            model.fit(inliers)
+    except (NotEnoughDataPointsException, IllDefinedDataPointsException):
+        found = False
+
+    if not found:
+        IJ.log("No correspondences found for " + name + ", left unregistered.")
+        return AffineTransform()
+    return model.createAffine()
+
+
+def use_phase_correlation(parameters):
+    """ Translation-only drift is registered by phase correlation
+        instead of SIFT, unless disabled in the settings. """
+
+    return (parameters["phase_corr"] and parameters["feat_model"] == 0
+            and parameters["reg_model"] == 0)
+
+
+def phase_correlate_composites(names, reference_name, keys, dirs, parameters, cache):
+    """ Registers the given composites to the reference by FFT phase
+        correlation, stores translation transforms in the cache and
+        writes a confidence score per timepoint to Tables. """
+
+    reference = IJ.openImage(os.path.join(dirs["Composites"], reference_name))
+    width, height = reference.getWidth(), reference.getHeight()
+
+    # FHT needs a power of 2 square, the centre of the frame is used.
+    size = 2
+    while size * 2 <= min(width, height):
+        size *= 2
+    x, y = (width - size) / 2, (height - size) / 2
+    window = hann_window(size)
+    reference_fht = windowed_fht(reference.getProcessor(), x, y, window)
+    reference.close()
+
+    print ("Phase correlation of " + str(len(names)) + " timepoints...")
+
+    def correlate(state, name):
+        imp = IJ.openImage(os.path.join(dirs["Composites"], name))
+        dx, dy, confidence = phase_correlation(
+            windowed_fht(imp.getProcessor(), x, y, window), reference_fht)
         imp.close()
 
-	
-def Weka_Segm(dirs):
-	""" Loads trained classifier and segments cells """ 
-	"""	in aligned images according to training.    """
+        # Maps the timepoint back onto the reference, as RVSS transforms do.
+        model = TranslationModel2D()
+        model.set(-dx, -dy)
+        with open(os.path.join(cache, keys[name] + ".xml"), "w") as xmlfile:
+            xmlfile.write(model.toXML(""))
+        return dx, dy, confidence
+
+    results = worker_pool(names, correlate, parameters["workers"])
+
+    with open(os.path.join(dirs["Tables"], "Registration_confidence.txt"), "w") as table:
+        table.write("Timepoint\tdx\tdy\tConfidence\n")
+        for name, (dx, dy, confidence) in zip(names, results):
+            table.write("%s\t%.3f\t%.3f\t%.2f\n" 
+                        % (os.path.splitext(name)[0], dx, dy, confidence))
+            if confidence < 10:
+                IJ.log("Low registration confidence (" + str(round(confidence, 1))
+                       + ") for " + name)
+
+
+def hann_window(size):
+    """ 2D Hann window, suppresses the frame edges in the FFT. """
+
+    hann = [0.5 - 0.5 * cos(2 * pi * i / (size - 1)) for i in range(size)]
+    row = FloatProcessor(size, 1, array(hann, "f"), None)
+    window = FloatProcessor(size, size)
+    for y, weight in enumerate(hann):
+        line = row.duplicate()
+        line.multiply(weight)
+        window.insert(line, 0, y)
+    return window
+
+
+def windowed_fht(ip, x, y, window):
+    """ Hartley transform of the mean-subtracted, windowed
+        window-sized region of ip at x, y. """
+
+    size = window.getWidth()
+    ip = ip.convertToFloat()
+    ip.setRoi(x, y, size, size)
+    ip = ip.crop()
+    ip.subtract(ImageStatistics.getStatistics(ip, Measurements.MEAN, None).mean)
+    ip.copyBits(window, 0, 0, Blitter.MULTIPLY)
+
+    fht = FHT(ip)
+    fht.transform()
+    return fht
+
+
+def phase_correlation(fht, reference_fht):
+    """ Shift of an image relative to the reference from their Hartley
+        transforms, returns (dx, dy, confidence). The peak is refined to
+        subpixels by a parabola fit, confidence is its height above the
+        correlation surface in standard deviations. """
+
+    cross = fht.conjugateMultiply(reference_fht)
+    size = cross.getWidth()
+
+    # Cross-power magnitude, |C(k)|^2 = (H(k)^2 + H(-k)^2)/2. H(-k) is
+    # H mirrored about the origin, rolled by one pixel.
+    flipped = cross.duplicate()
+    flipped.flipHorizontal()
+    flipped.flipVertical()
+    mirrored = FloatProcessor(size, size)
+    for offset_x, offset_y in ((1, 1), (1 - size, 1), (1, 1 - size), (1 - size, 1 - size)):
+        mirrored.copyBits(flipped, offset_x, offset_y, Blitter.COPY)
+    magnitude = cross.duplicate()
+    magnitude.sqr()
+    mirrored.sqr()
+    magnitude.copyBits(mirrored, 0, 0, Blitter.ADD)
+    magnitude.multiply(0.5)
+    magnitude.sqrt()
+    magnitude.add(1e-12)
+
+    # Keeps the phase only, the peak becomes a near delta function.
+    cross.copyBits(magnitude, 0, 0, Blitter.DIVIDE)
+    cross.inverseTransform()
+    cross.swapQuadrants()
+
+    stats = ImageStatistics.getStatistics(
+        cross, Measurements.MEAN + Measurements.MIN_MAX + Measurements.STD_DEV,
+        None)
+    cross.setThreshold(stats.max, stats.max, ImageProcessor.NO_LUT_UPDATE)
+    peak = ThresholdToSelection.run(ImagePlus("", cross)).getBounds()
+
+    def vertex(left, centre, right):
+        curvature = left - 2 * centre + right
+        if curvature == 0:
+            return 0.0
+        return 0.5 * (left - right) / curvature
+
+    dx, dy = float(peak.x - size / 2), float(peak.y - size / 2)
+    if 0 < peak.x < size - 1:
+        dx += vertex(cross.getf(peak.x - 1, peak.y), cross.getf(peak.x, peak.y),
+                     cross.getf(peak.x + 1, peak.y))
+    if 0 < peak.y < size - 1:
+        dy += vertex(cross.getf(peak.x, peak.y - 1), cross.getf(peak.x, peak.y),
+                     cross.getf(peak.x, peak.y + 1))
+
+    if stats.stdDev > 0:
+        confidence = (stats.max - stats.mean) / stats.stdDev
+    else:
+        confidence = 0.0
+
+    return dx, dy, confidence
+
+
+def cache_dir(*parts):
+    """ Persistent cache directory under Root, shared by all runs
+        (every run gets a fresh experiment directory). """
+
+    path = os.path.join(str(Root), "FRET_cache", *parts)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def file_hash(path):
+    """ SHA-1 of a file's content. """
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as hashfile:
+        for block in iter(lambda: hashfile.read(1 << 20), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def Transformer(channels, dirs, parameters):
+    """ Applies transformation matrices from Composite_Aligner to all raw, 32-bit projections.
+        Each timepoint's transform is read once and applied to all of its channels. """
+
+    transforms = sorted(filename for filename in os.listdir(dirs["Transformations"])
+                        if filename.endswith(".xml"))
+
+    # Optionally one memory-mapped float32 file instead of TIFFs.
+    if parameters["aligned_raw"]:
+        raw_path = os.path.join(dirs["Aligned_All"], RAW_STACK)
+    else:
+        raw_path = None
+
+    print "Transforming channels..."
+    transform_images([(os.path.join(dirs["Transformations"], xml),
+                       timepoint_projections(dirs, scan, channels))
+                      for scan, xml in enumerate(transforms)],
+                     dirs["Aligned_All"], parameters["workers"], raw_path)
+    print "Channels transformed."
+
+
+def transform_images(tasks, target_dir, workers, raw_path=None):
+    """ Applies RVSS transforms to images without opening windows. tasks is a
+        list of (transform file, [image paths]), every transform is parsed once
+        and mapped onto the images of its task, tasks run in parallel. All
+        results share one canvas, the union of the transformed image bounds,
+        as Transform_Virtual_Stack_MT renders it. With raw_path the results
+        go to a raw float32 stack (task x image x y x x) instead of TIFFs.
+        Returns the canvas rectangle. """
+
+    transforms = [Transform_Virtual_Stack_MT.readCoordinateTransform(xml)
+                  for xml, paths in tasks]
+
+    # Images of a run all have the size of the (cropped) projections.
+    first = IJ.openImage(tasks[0][1][0])
+    width, height = first.getWidth(), first.getHeight()
+    first.close()
+
+    bounds = None
+    for transform in transforms:
+        box = CoordinateTransformMesh(transform, 32, width, height).getBoundingBox()
+        if bounds is None:
+            bounds = box
+        else:
+            bounds.add(box)
+
+    def setup():
+        return RandomAccessFile(raw_path, "rw").getChannel()
+
+    if raw_path is not None:
+        create_raw_stack(raw_path, [len(tasks), len(tasks[0][1]), 
+                                    bounds.height, bounds.width])
+    else:
+        setup = None
+
+    def apply(state, task):
+        index, transform, paths = task
+        
+        # Shifts the common canvas to the origin.
+        shift = TranslationModel2D()
+        shift.set(-bounds.x, -bounds.y)
+        ctl = CoordinateTransformList()
+        ctl.add(transform)
+        ctl.add(shift)
+        mapping = TransformMeshMapping(CoordinateTransformMesh(ctl, 32, width, height))
+
+        for plane, path in enumerate(paths):
+            imp = IJ.openImage(path)
+            ip = imp.getProcessor()
+            ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+            target = ip.createProcessor(bounds.width, bounds.height)
+            mapping.mapInterpolated(ip, target)
+
+            if state is not None:
+                write_raw_plane(state, index * len(paths) + plane, target)
+                imp.close()
+                continue
+
+            out = ImagePlus(imp.getTitle(), target)
+            if not FileSaver(out).saveAsTiff(os.path.join(target_dir, os.path.basename(path))):
+                raise IOError("Could not save " + os.path.join(target_dir, os.path.basename(path)))
+            imp.close()
+
+    worker_pool([(index, transform, paths) for index, (transform, (xml, paths))
+                 in enumerate(zip(transforms, tasks))],
+                apply, workers, setup, lambda channel: channel.close())
+
+    return bounds
+
+
+# Raw float32 stack: a JSON header padded to RAW_HEADER bytes, then
+# little-endian planes, timepoint-major (shape [timepoints, channels, y, x]).
+RAW_STACK = "Aligned_All.f32"
+RAW_HEADER = 4096
+
+
+def create_raw_stack(path, shape):
+    """ Creates a zero-filled raw stack of the given shape. """
+
+    header = json.dumps({"version" : 1, "dtype" : "<f4", "shape" : shape,
+                         "offset" : RAW_HEADER})
+    with open(path, "wb") as rawfile:
+        rawfile.write(header.ljust(RAW_HEADER - 1) + "\n")
+        rawfile.seek(RAW_HEADER + 4 * shape[0] * shape[1] * shape[2] * shape[3] - 1)
+        rawfile.write("\0")
+
+
+def write_raw_plane(channel, index, ip):
+    """ Writes ip as plane index of a raw stack through its FileChannel,
+        positional writes let workers share the file. """
+
+    pixels = ip.convertToFloat().getPixels()
+    buffer = ByteBuffer.allocate(4 * len(pixels)).order(ByteOrder.LITTLE_ENDIAN)
+    buffer.asFloatBuffer().put(pixels)
+    position = RAW_HEADER + index * buffer.capacity()
+    while buffer.hasRemaining():
+        position += channel.write(buffer, position)
+
+
+class RawStack(object):
+    """ Read access to a raw float32 stack, planes are memory-mapped
+        (a page fault, no decode) and copied into FloatProcessors. """
+
+    def __init__(self, path):
+        with open(path, "rb") as rawfile:
+            header = json.loads(rawfile.read(RAW_HEADER))
+        self.timepoints, self.channels, self.height, self.width = header["shape"]
+        self.offset = header["offset"]
+        self.file = RandomAccessFile(path, "r")
+        self.channel = self.file.getChannel()
+
+    def __len__(self):
+        return self.timepoints * self.channels
+
+    def processor(self, index):
+        """ Plane index (timepoint * channels + channel). """
+
+        size = self.width * self.height
+        mapped = self.channel.map(FileChannel.MapMode.READ_ONLY,
+                                  self.offset + 4 * size * index, 4 * size)
+        pixels = zeros(size, "f")
+        mapped.order(ByteOrder.LITTLE_ENDIAN).asFloatBuffer().get(pixels)
+        return FloatProcessor(self.width, self.height, pixels)
+
+    def close(self):
+        self.file.close()
+
+
+def Cell_Segm(dirs, parameters):
+	""" Segments cells in the aligned reference with the selected engine,
+	    fills the RoiManager with one ROI per cell. Results are cached,
+	    unchanged inputs skip segmentation. """
 	
 	# Define reference image for segmentation (default is timepoint000).
 	w_train = os.path.join(dirs["Composites_Aligned"], "Timepoint000.tif")
+
+	# Cache key: reference image, engine parameters (and classifier).
+	if parameters["seg_engine"] == 1:
+		keys = ["seg_engine", "seg_method", "seg_smooth", "cell_min", "cell_max"]
+		inputs = [w_train]
+	else:
+		if classifier is None:
+			raise IOError("Weka segmentation needs a classifier file")
+		keys = ["seg_engine", "ws_erosion", "ws_convexity", "ws_sep_min",
+		        "ws_sep_max", "weka_tile", "weka_margin"]
+		inputs = [w_train, str(classifier)]
+	key = hashlib.sha1(parameter_hash(parameters, keys)
+	                   + "".join(file_hash(path) for path in inputs)).hexdigest()
+	cached = os.path.join(cache_dir("segmentation"), key)
+
+	RoiManager()
+	rm = RoiManager.getInstance()
+	rm.runCommand("reset")
+
+	if os.path.exists(cached + ".zip"):
+		print "Segmentation read from cache."
+		segmentation = IJ.openImage(cached + ".tif")
+		segmentation.show()
+		rm.runCommand("Open", cached + ".zip")
+		return
+
+	if parameters["seg_engine"] == 1:
+		segmentation = Classical_Segm(w_train, parameters)
+	else:
+		segmentation = Weka_Segm(w_train, parameters)
+	segmentation.show()
+
+	# Make selection of the thresholded cells and add to RoiManager.
+	roi = ThresholdToSelection.run(segmentation)
+	segmentation.setRoi(roi)
+	rm.addRoi(roi)
+	rm.runCommand("Split")
+
+	# Label image first, the ROI set marks a complete cache entry.
+	if not FileSaver(segmentation).saveAsTiff(cached + ".tif"):
+		raise IOError("Could not save " + cached + ".tif")
+	rm.runCommand("Save", cached + ".zip")
+
+
+def Weka_Segm(w_train, parameters):
+	""" Loads trained classifier and segments cells """ 
+	"""	in aligned images according to training.    """
+	"""	Returns the watershed image, cells thresholded. """
+
 	trainer = IJ.openImage(w_train)
-	weka = WekaSegmentation()
-	weka.setTrainingImage(trainer)
+	if parameters["weka_tile"] > 0:
+		segmentation = tiled_classification(trainer, parameters)
+	else:
+		weka = WekaSegmentation()
+		weka.setTrainingImage(trainer)
 	
-	# Select classifier model.
-	weka.loadClassifier(str(classifier))
+		# Select classifier model.
+		weka.loadClassifier(str(classifier))
      
-	weka.applyClassifier(False)
-	segmentation = weka.getClassifiedImage()
+		weka.applyClassifier(False)
+		segmentation = weka.getClassifiedImage()
 	segmentation.show()
 
 	# Convert image to 8bit
@@ -620,119 +1687,354 @@ def Weka_Segm(dirs):
 	
 	# Run Watershed Irregular Features plugin, with parameters.
 	IJ.run(segmentation, "Watershed Irregular Features",
-	      "erosion=20 convexity_treshold=0 separator_size=0-Infinity")
+	      watershed_options(parameters))
 
-	# Make selection and add to RoiManager.	
-	RoiManager()
-	rm = RoiManager.getInstance()
-	rm.runCommand("reset")
-	roi = ThresholdToSelection.run(segmentation)
-	segmentation.setRoi(roi)
-	rm.addRoi(roi)
-	rm.runCommand("Split")
+	return segmentation
 
 
-def Measurements(channels, timelist, dirs, parameters):
-    """ Takes measurements of weka selected ROIs in a generated aligned image stack. """
-	
-    # Set desired measurements. 
-    an = Analyzer()
-    an.setMeasurements(an.AREA + an.MEAN + an.MIN_MAX + an.SLICE)
+def Classical_Segm(w_train, parameters):
+    """ Segments bright somata without a classifier: auto threshold, 
+        hole filling, distance transform watershed and a size filter
+        (Max/Min Cell Area). Returns the mask, cells thresholded. """
 
-    # Opens raw-projections as stack.
-    test = IJ.run("Image Sequence...",
-	              "open=" + dirs["Aligned_All"]
-	              + " number=400 starting=1 increment=1 scale=400 file=.tif sort")
+    imp = IJ.openImage(w_train)
+    ip = imp.getProcessor().convertToByte(True)
+    imp.close()
+    if parameters["seg_smooth"] > 0:
+        ip.blurGaussian(parameters["seg_smooth"])
+
+    # Cells (above threshold) to 255, background to 0.
+    method = getattr(Auto_Threshold, SEG_METHODS[parameters["seg_method"]])
+    ip.threshold(method(ip.getHistogram()))
+    mask = ImagePlus("Segmentation", ip)
+
+    # Binary fill works on 255 foreground with a black background.
+    black_background = Prefs.blackBackground
+    Prefs.blackBackground = True
+    try:
+        binary = Binary()
+        binary.setup("fill", mask)
+        binary.run(ip)
+    finally:
+        Prefs.blackBackground = black_background
+
+    # Splits touching cells along the watershed of the distance map.
+    EDM().toWatershed(ip)
+
+    # Drops particles outside the cell size range.
+    ip.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+    pa = ParticleAnalyzer(ParticleAnalyzer.SHOW_MASKS, 0, None,
+                          parameters["cell_min"], parameters["cell_max"])
+    pa.setHideOutputImage(True)
+    pa.analyze(mask, ip)
+    segmentation = pa.getOutputImage()
+    segmentation.getProcessor().setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+    segmentation.setTitle("Segmentation")
+
+    return segmentation
+
+
+def tiled_classification(imp, parameters):
+    """ Classifies imp in overlapping tiles on the worker pool, peak memory
+        is bound by the tile size. Each worker loads the classifier once,
+        tiles are classified with their margins (for the features at the
+        tile edges) and the labels of the tile core are stitched into a
+        class index image, as applyClassifier(False) returns it. """
+
+    width, height = imp.getWidth(), imp.getHeight()
+    tile, margin = parameters["weka_tile"], parameters["weka_margin"]
+
+    tiles = [(x, y, min(tile, width - x), min(tile, height - y))
+             for y in range(0, height, tile) for x in range(0, width, tile)]
+
+    # Workers crop their tiles from the shared processor in turn.
+    source, lock = imp.getProcessor(), threading.Lock()
+
+    # No training image: the full frame is never handed to Weka, the
+    # features are computed per tile in applyClassifier().
+    def setup():
+        weka = WekaSegmentation()
+        weka.loadClassifier(str(classifier))
+        return weka
+
+    def classify(weka, core):
+        x, y, w, h = core
+        x0, y0 = max(0, x - margin), max(0, y - margin)
+        x1, y1 = min(width, x + w + margin), min(height, y + h + margin)
+
+        with lock:
+            source.setRoi(x0, y0, x1 - x0, y1 - y0)
+            ip = source.crop()
+        labels = weka.applyClassifier(ImagePlus("tile", ip), 1, False).getProcessor()
+
+        # Tile core, margins dropped.
+        labels.setRoi(x - x0, y - y0, w, h)
+        return labels.crop().convertToByte(False)
+
+    print ("Classifying " + str(len(tiles)) + " tiles...")
+    classified = ByteProcessor(width, height)
+    for (x, y, w, h), labels in zip(tiles, worker_pool(tiles, classify,
+                                                       parameters["workers"], setup)):
+        classified.insert(labels, x, y)
+
+    return ImagePlus("Classified image", classified)
+
+
+def watershed_options(parameters):
+	""" Watershed Irregular Features options from the parameters. """
+
+	if parameters["ws_sep_max"] > 0:
+		separator_max = str(parameters["ws_sep_max"])
+	else:
+		separator_max = "Infinity"
+
+	return ("erosion=" + str(parameters["ws_erosion"])
+	        + " convexity_treshold=" + str(parameters["ws_convexity"])
+	        + " separator_size=" + str(parameters["ws_sep_min"]) + "-" + separator_max)
+
+
+def Cell_Measurements(channels, timelist, dirs, parameters):
+    """ Takes measurements of segmented ROIs in the aligned images. """
+
+    # Aligned raw-projections, streamed one image at a time from the 
+    # TIFFs or the raw stack. The first is shown for the ROI check.
+    raw_path = os.path.join(dirs["Aligned_All"], RAW_STACK)
+    if os.path.exists(raw_path):
+        raw = RawStack(raw_path)
+        count, read_plane = len(raw), raw.processor
+    else:
+        raw = None
+        paths = [os.path.join(dirs["Aligned_All"], filename)
+                 for filename in sorted(os.listdir(dirs["Aligned_All"]))
+                 if filename.endswith(".tif")]
+        count = len(paths)
+        read_plane = lambda index: IJ.openImage(paths[index]).getProcessor()
+    imp = ImagePlus("Aligned", read_plane(0))
+    imp.show()
 
     # Calls roimanager.
     rm = RoiManager.getInstance()	
     total_rois = rm.getCount()
 
-    # Deletes artefact ROIs (too large or too small). 
-    imp = WindowManager.getCurrentImage()
-    for roi in reversed(range(total_rois)):
-        rm.select(roi)
-        size = imp.getStatistics().area		
-        if size < int(float(parameters["cell_min"])):
-            rm.select(roi)
-            rm.runCommand('Delete')
-        elif size > int(float(parameters["cell_max"])):
-            rm.select(roi)
-            rm.runCommand('Delete')
-        else:
-            rm.runCommand("Deselect")
+    # Deletes artefact ROIs (too large or too small), areas from
+    # one label image histogram, only the kept ROIs are re-added.
+    rois = rm.getRoisAsArray()
+    calibration = imp.getCalibration()
+    pixel_area = calibration.pixelWidth*calibration.pixelHeight
+    labels, overlapping = label_image(rois, imp.getWidth(), imp.getHeight())
+    areas = label_areas(labels, len(rois), pixel_area)
+    # Overlapping ROIs are sized by all their own pixels.
+    for index in overlapping:
+        areas[index] = len(rois[index].getContainedPoints()) * pixel_area
+    kept = [roi for roi, size in zip(rois, areas)
+            if parameters["cell_min"] <= size <= parameters["cell_max"]]
+    rm.runCommand("reset")
+    for roi in kept:
+        rm.addRoi(roi)
+    print "Size filter kept", len(kept), "of", total_rois, "selections."
 
     # Confirm that ROI selection is Ok (comment out for headless run).
     WaitForUserDialog("ROI check", "Control ROI selection, then click OK").show() 
 	
-    # Measure each ROI for each channel.
-    imp = WindowManager.getCurrentImage()
-    rm.runCommand("Select All")	
-    rm.runCommand("multi-measure measure_all One row per slice")		
-	
-    # Close.
-    imp = WindowManager.getCurrentImage()
+    # Measure every cell in every image, one pass per image.
+    rois = rm.getRoisAsArray()
+    Cell_number = len(rois)
+    labels, overlapping = label_image(rois, imp.getWidth(), imp.getHeight())
+    if overlapping:
+        IJ.log("Overlapping cell selections (shared pixels not measured): "
+               + ", ".join(str(index + 1) for index in overlapping))
+    stats = label_measurements(read_plane, count, labels, rois, calibration,
+                               parameters["workers"])
+    total_slices = count
     imp.close()
-
-    # Get measurement results.
-    rt = ResultsTable.getResultsTable()
-    Area = rt.getColumn(0)
-    Mean = rt.getColumn(1)
-    Slice = rt.getColumn(27)
-	
-    # Removes (and counts) artefact ROIs (redundant)
-    # Area indices without outliers
-    Area_indices = [index for (index, value) in enumerate(Area, start=0)
-	                if value > 0 and value < 9999999]
-	
-    # Mean without outliers from area (redundant)
-    Filtered_mean = [Mean[index] for index in Area_indices]
-    Filtered_slice = [Slice[index] for index in Area_indices]
-
-    # Number of cell selections.
-    Cell_number = Filtered_slice.count(1.0)
-    rm = RoiManager.getInstance()
+    if raw is not None:
+        raw.close()
     print "Number of selected cells: ", Cell_number
-    print "Total number of selections: ", rm.getCount()
 
-    Cells = [ Filtered_mean [x : x + Cell_number]
-	          for x in xrange (0, len(Filtered_mean), Cell_number) ]
-              	
-    Cells_indices = [ index for (index, value) in enumerate(Cells) ]
-	
-    time = [ x for item in timelist for x in repeat(item, Cell_number) ]
-    time = [ time [x : x + Cell_number] for x in xrange (0, len(time), Cell_number) ]
-	
-    Slices = [ Filtered_slice [x : x + Cell_number]
-	           for x in xrange (0, len(Filtered_slice), Cell_number) ]
-	
-    # Lists IDD, IDA + IAA if 3ch.
-    if channels == 3:
-        IDD_list = [ Cells [index] for index in Cells_indices [0::int(channels)] ]
-        IDA_list = [ Cells [index] for index in Cells_indices [1::int(channels)] ]    
-        IAA_list = [ Cells [index] for index in Cells_indices [2::int(channels)] ]
-        
-        raw_data = {"IDD" : IDD_list, "IDA" : IDA_list, "IAA" : IAA_list,
-                    "Cell_num" : Cell_number, "Slices" : Slices,
-                    "Time" : time
-                    }
-	
-	
-    elif channels == 2:
-        IDD_list = [ Cells [index] for index in Cells_indices [0::int(channels)] ]
-        IDA_list = [ Cells [index] for index in Cells_indices [1::int(channels)] ]
-        
-        raw_data = {"IDD": IDD_list, "IDA" : IDA_list,
-                    "Cell_num" : Cell_number, "Slices" : Slices,
-                    "Time" : time
-                    }
+    # Cell means into the dataset, slices are timepoint-major, channel-minor.
+    dataset = FretDataset(Cell_number, total_slices // channels, channels, timelist)
+    for index in range(total_slices):
+        timepoint, channel = divmod(index, channels)
+        System.arraycopy(stats["Mean"], index * Cell_number, dataset.values,
+                         dataset.offset(channel, timepoint), Cell_number)
 
-    return raw_data
+    return dataset
 	
 
-def three_cube(raw_data, LP):
-    """ Performs calculations on nested list data from three channels, 
-        returns calculations as nested lists. """
+class ArrayView(object):
+    """ Read-only strided view of a flat array, indexing and iteration
+        read the array in place (no copy). """
+
+    __slots__ = ("data", "start", "step", "count")
+
+    def __init__(self, data, start, step, count):
+        self.data = data
+        self.start = start
+        self.step = step
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("view index out of range")
+        return self.data[self.start + index * self.step]
+
+    def __iter__(self):
+        data, step = self.data, self.step
+        for index in xrange(self.start, self.start + self.count * step, step):
+            yield data[index]
+
+    def tolist(self):
+        return list(self)
+
+
+class FretDataset(object):
+    """ Mean intensities of every cell, timepoint and channel in one flat
+        double array, channel-major then timepoint-major, so a channel is
+        one contiguous timepoint-major block. time holds the timepoints
+        (minutes), cell_ids the cell numbers (ROI order, from 1), slices
+        the stack slice numbers of the measured images (from 1). """
+
+    __slots__ = ("cells", "timepoints", "channels", "values", "time", "cell_ids",
+                 "slices")
+
+    def __init__(self, cells, timepoints, channels, time, cell_ids=None):
+        self.cells = cells
+        self.timepoints = timepoints
+        self.channels = channels
+        self.values = zeros(cells * timepoints * channels, "d")
+        self.time = list(time[:timepoints])
+        self.cell_ids = cell_ids or range(1, cells + 1)
+        self.slices = range(1, timepoints * channels + 1)
+
+    def offset(self, channel, timepoint=0):
+        return (channel * self.timepoints + timepoint) * self.cells
+
+    def channel(self, channel):
+        """ All cells and timepoints of a channel, timepoint-major. """
+        return ArrayView(self.values, self.offset(channel), 1, 
+                         self.timepoints * self.cells)
+
+    def timepoint(self, channel, timepoint):
+        """ All cells of a channel at one timepoint. """
+        return ArrayView(self.values, self.offset(channel, timepoint), 1, self.cells)
+
+    def cell(self, channel, cell):
+        """ One cell of a channel over all timepoints. """
+        return ArrayView(self.values, self.offset(channel) + cell, self.cells,
+                         self.timepoints)
+
+
+def label_measurements(read_plane, count, labels, rois, calibration, workers):
+    """ Area, mean, min and max of every cell in every image (slice). Cell
+        masks are cut from the label image once, each image is read with
+        read_plane(index), measured by ImageStatistics over every cell's
+        bounds and mask (the pixel loops run in Java) and dropped. Images
+        run on the worker pool so memory stays constant. Returns a float
+        array per statistic, indexed slice * cells + cell (slices are
+        timepoint-major, channel-minor). Cells without pixels get NaN. """
+
+    # Cell pixels as bounds + mask, shared read-only by the workers.
+    masks = label_masks(labels, rois)
+    cells = len(masks)
+    options = Measurements.AREA + Measurements.MEAN + Measurements.MIN_MAX
+    nan = float("nan")
+    stats = dict((name, zeros(count * cells, "d"))
+                 for name in ("Area", "Mean", "Min", "Max"))
+
+    def measure(state, index):
+        ip = read_plane(index)
+        offset = index * cells
+        for cell, mask in enumerate(masks):
+            if mask is None:
+                stats["Mean"][offset + cell] = nan
+                stats["Min"][offset + cell] = nan
+                stats["Max"][offset + cell] = nan
+                continue
+            ip.setRoi(mask[0])
+            ip.setMask(mask[1])
+            cell_stats = ImageStatistics.getStatistics(ip, options, calibration)
+            stats["Area"][offset + cell] = cell_stats.area
+            stats["Mean"][offset + cell] = cell_stats.mean
+            stats["Min"][offset + cell] = cell_stats.min
+            stats["Max"][offset + cell] = cell_stats.max
+
+    worker_pool(range(count), measure, workers)
+    return stats
+
+
+def label_image(rois, width, height):
+    """ 16-bit label image, pixels of ROI i are i + 1, background 0. 
+        Pixels shared by overlapping ROIs belong to none of them, so the
+        ROI order does not decide. Returns the label image and the
+        indices of the overlapping ROIs. """
+
+    if len(rois) > 65535:
+        raise ValueError(str(len(rois)) + " cell selections, a 16-bit "
+                         "label image holds at most 65535")
+
+    labels = ShortProcessor(width, height)
+    shared, overlapping = [], set()
+    for index, roi in enumerate(rois):
+        # Labelled pixels under the ROI are shared with earlier ROIs,
+        # only these (rare) ROIs are scanned pixel by pixel.
+        labels.setRoi(roi)
+        if labels.getStatistics().max > 0:
+            bounds = roi.getBounds().intersection(Rectangle(0, 0, width, height))
+            for y in range(bounds.y, bounds.y + bounds.height):
+                for x in range(bounds.x, bounds.x + bounds.width):
+                    label = labels.get(x, y)
+                    if label and roi.contains(x, y):
+                        shared.append((x, y))
+                        overlapping.update((label - 1, index))
+        labels.setValue(index + 1)
+        labels.fill(roi)
+    labels.resetRoi()
+
+    for x, y in shared:
+        labels.set(x, y, 0)
+    return labels, sorted(overlapping)
+
+
+def label_masks(labels, rois):
+    """ Bounds and mask of every cell from the label image: the mask of
+        ROI i holds the pixels labelled i + 1 within the ROI bounds, cut
+        out with a lookup table. Cells without labelled pixels get None. """
+
+    frame = Rectangle(0, 0, labels.getWidth(), labels.getHeight())
+    areas = label_areas(labels, len(rois))
+    table = zeros(65536, "i")
+    masks = []
+    for index, roi in enumerate(rois):
+        bounds = roi.getBounds().intersection(frame)
+        if not areas[index] or bounds.isEmpty():
+            masks.append(None)
+            continue
+        labels.setRoi(bounds)
+        mask = labels.crop()
+        table[index + 1] = 255
+        mask.applyTable(table)
+        table[index + 1] = 0
+        masks.append((bounds, mask.convertToByte(False)))
+    labels.resetRoi()
+    return masks
+
+
+def label_areas(labels, count, pixel_area=1.0):
+    """ Areas of labels 1..count, from one histogram of the label image. """
+
+    histogram = labels.getHistogram()
+    return [histogram[label] * pixel_area for label in range(1, count + 1)]
+
+
+def three_cube(dataset, LP, parameters):
+    """ Performs calculations on the three channel dataset, returns
+        calculations as flat timepoint-major arrays, with cFRET and the
+        corrected donor concentration. """
     
     # Direct excitation of acceptor, AER, and 
     # donor emission bleedthrough, DER, cofficients.
@@ -740,226 +2042,355 @@ def three_cube(raw_data, LP):
     AER = ((8.8764*(LP**2)) + (1.8853*LP)) - 0.1035 
     DER = 0.1586
 
-    IDD_list, IDA_list, IAA_list = raw_data["IDD"], raw_data["IDA"], raw_data["IAA"]
+    # Calculations, flat arrays (timepoint-major) from one pass.
+    values = fret_engine(dataset.channel(0), dataset.channel(1), dataset.channel(2), 
+                         AER, DER)
+    flat_aFRET, flat_dFRET, flat_raw = values["aFRET"], values["dFRET"], values["Raw"]
     
-    Cell_number = raw_data["Cell_num"]
+    # Baseline-normalized values (and relative to the first timepoint).
+    norm_aFRET, norm_aFRET_self = normalized_pair(flat_aFRET, dataset, parameters)
+    norm_dFRET, norm_dFRET_self = normalized_pair(flat_dFRET, dataset, parameters)
+    norm_raw, norm_raw_self = normalized_pair(flat_raw, dataset, parameters)
     
-    # Calculations.
-    Raw_ratio = [ [ IDA / IDD for (IDA, IDD) in zip(x, y) ] for (x, y) in zip(IDA_list, IDD_list) ]
-    
-    cFRET = [ [ IDA - (AER*IAA) - (DER*IDD) 
-                for (IDA, IAA, IDD) in zip(x, y, z) ] 
-                for (x, y, z) in zip(IDA_list, IAA_list, IDD_list) ]
-    
-    dFRET = [ [ (IDA - (AER*IAA) - (DER*IDD)) / (IDD + CFRET) 
-                for (IDA, IDD, IAA, CFRET) in zip(x, y, z, c) ] 
-                for (x, y, z, c) in zip(IDA_list, IDD_list, IAA_list, cFRET) ]
-    
-    aFRET = [ [ ((IDA - (AER*IAA) - (DER*IDD)) / (IAA*AER))/4.66 
-                for (IDA, IDD, IAA) in zip(x, y, z) ] 
-                for (x, y, z) in zip(IDA_list, IDD_list, IAA_list) ]    
-    
-    dtoa = [ [ ((IDD + CFRET)/4.66) / (IAA*AER) 
-                for (IDD, CFRET, IAA) in zip(x, y, z) ] 
-                for (x, y, z) in zip(IDD_list, cFRET, IAA_list) ]
-    
-    # Flattens nested lists for normalization function.
-    flat_aFRET = [item for sublist in aFRET for item in sublist]
-    flat_dFRET = [item for sublist in dFRET for item in sublist]
-    flat_raw = [item for sublist in Raw_ratio for item in sublist]
-
-    aFRET_base = flat_aFRET [0:Cell_number]
-    aFRET_base_mean = standard_deviation(aFRET_base)
-    
-    dFRET_base = flat_dFRET [0:Cell_number]
-    dFRET_base_mean = standard_deviation(dFRET_base)
-
-    
-    """ Calculates baseline-normalized values. """
-    norm_aFRET, norm_aFRET_self = [], []
-    norm_dFRET, norm_dFRET_self = [], []
-    norm_raw, norm_raw_self = [], []
-    baseline = Cell_number * Control_num
-    
-    for cell in range(Cell_number):
-                    # Divides value 0->max by baseline point 0-Cell_number for each cell.
-            norm_aFRET.append([ (flat_aFRET[v]) / ((sum(flat_aFRET[cell:baseline:Cell_number]))
-                                /len(flat_aFRET[cell:baseline:Cell_number])) 
-                                for v in range(cell, len(flat_aFRET), Cell_number)])
-            
-            norm_dFRET.append([ (flat_dFRET[v]) / ((sum(flat_dFRET[cell:baseline:Cell_number]))
-                                /len(flat_dFRET[cell:baseline:Cell_number]))
-                                for v in range(cell, len(flat_dFRET), Cell_number)])
-                    
-            norm_raw.append([ (flat_raw[v]) / ((sum(flat_raw[cell:baseline:Cell_number]))
-                              /len(flat_raw[cell:baseline:Cell_number])) 
-                              for v in range(cell, len(flat_raw), Cell_number)])
-            
-            norm_aFRET_self.append([ (flat_aFRET[v]) / (flat_aFRET[cell])
-                                     for v in range(cell, len(flat_aFRET), Cell_number)])
-            
-            norm_dFRET_self.append([ (flat_dFRET[v]) / (flat_dFRET[cell]) 
-                                     for v in range(cell, len(flat_dFRET), Cell_number)])   
-            
-            norm_raw_self.append([ (flat_raw[v]) / (flat_raw[cell])
-                                    for v in range(cell, len(flat_raw), Cell_number)])
-            
-    # Zips [[cell1],[cell2]] to [[time1],[time2]].
-    norm_aFRET = list(chain.from_iterable(zip(*norm_aFRET)))
-    norm_dFRET = list(chain.from_iterable(zip(*norm_dFRET)))
-    norm_raw = list(chain.from_iterable(zip(*norm_raw)))
-    norm_aFRET_self = list(chain.from_iterable(zip(*norm_aFRET_self)))
-    norm_dFRET_self = list(chain.from_iterable(zip(*norm_dFRET_self)))
-    norm_raw_self = list(chain.from_iterable(zip(*norm_raw_self)))  
-    
-    # Rounds final outputs.
-    Raw_ratio = [ [round(float(i), 3) for i in nested] for nested in Raw_ratio ]
-    dFRET = [ [round(float(i), 3) for i in nested] for nested in dFRET ]
-    aFRET = [ [round(float(i), 3) for i in nested] for nested in aFRET ]
-    cFRET = [ [int(i) for i in nested] for nested in cFRET ]
-    dtoa = [ [round(float(i), 3) for i in nested] for nested in dtoa ]
-    norm_aFRET = [round(float(i), 5) for i in norm_aFRET]
-    norm_dFRET = [round(float(i), 5) for i in norm_dFRET]
-    norm_raw = [round(float(i), 5) for i in norm_raw]
-    
-    A_Conc = [ [ (IAA * AER) for (IAA) in x ] for x in IAA_list ]
-
+    # Full precision, rounded when tabulated.
     # TODO: REMOVE UNWANTED PLOT VALUES, cFRET GOES SOLO
-    FRET_val = {"dFRET" : dFRET, "aFRET" : aFRET,
-                "Raw" : Raw_ratio, "DtoA" : dtoa, 
-                "A_Conc" : A_Conc, "Normalized aFRET" : norm_aFRET, 
+    FRET_val = {"dFRET" : flat_dFRET, "aFRET" : flat_aFRET,
+                "Raw" : flat_raw, "DtoA" : values["DtoA"], 
+                "A_Conc" : values["A_Conc"], "Normalized aFRET" : norm_aFRET, 
                 "Normalized dFRET" : norm_dFRET, 
                 "Normalized aFRET mean" : norm_aFRET_self,
                 "Normalized dFRET mean" : norm_dFRET_self,
                 }
     
-    return FRET_val, cFRET
+    return FRET_val, values["cFRET"], values["D_Conc"]
     
 
 
-def Ratiometric(raw_data, parameters):
-    """ Performs calculations on nested list data from two channels, 
-        returns calculations as nested lists. """
+def Ratiometric(dataset, parameters):
+    """ Performs calculations on the two channel dataset, 
+        returns calculations as flat timepoint-major arrays. """
 
-    IDD_list, IDA_list = raw_data["IDD"], raw_data["IDA"]
-    Cell_number = raw_data["Cell_num"]
     # Calculations
-    Raw_ratio = [ [ IDA / IDD for (IDA, IDD) in zip(x, y) ] 
-                    for (x, y) in zip(IDA_list, IDD_list) ]
-                 
-    Sergei_ratio = [[(IDA / IDD) - (float(parameters["subtr_ratio"]))
-                        for (IDA, IDD) in zip(x, y)] 
-                            for (x, y) in zip(IDA_list, IDD_list)]
+    values = fret_engine(dataset.channel(0), dataset.channel(1), 
+                         subtr_ratio=parameters["subtr_ratio"])
+    flat_raw, flat_Sergei = values["Raw"], values["Sergei"]
     
-    baseline = Cell_number * Control_num
-    norm_raw, norm_Sergei = [], []
-
-    flat_raw = [item for sublist in Raw_ratio for item in sublist]
+    norm_raw = normalized_pair(flat_raw, dataset, parameters)[0]
+    norm_Sergei = normalized_pair(flat_Sergei, dataset, parameters)[0]
 
-    flat_Sergei = [item for sublist in Sergei_ratio for item in sublist]
-    
-    for cell in range(Cell_number):
-        norm_raw.append([ (flat_raw[v]) / ((sum(flat_raw[cell:baseline:Cell_number]))
-                          /len(flat_raw[cell:baseline:Cell_number])) 
-                          for v in range(cell, len(flat_raw), Cell_number)])
-                          
-        norm_Sergei.append([ (flat_Sergei[v]) / ((sum(flat_Sergei[cell:baseline:Cell_number]))
-                             /len(flat_Sergei[cell:baseline:Cell_number]))
-                             for v in range(cell, len(flat_Sergei), Cell_number)])
-    
-    norm_raw = list(chain.from_iterable(zip(*norm_raw)))
-    norm_Sergei = list(chain.from_iterable(zip(*norm_Sergei)))
-    # Round.
-    Raw_ratio = [ [round(float(i), 3) for i in nested] for nested in Raw_ratio ]
-    Sergei_ratio = [ [round(float(i), 3) for i in nested] for nested in Sergei_ratio ]
-    norm_raw = [round(float(i), 5) for i in norm_raw]
-    norm_Sergei = [round(float(i), 5) for i in norm_Sergei]
-
-    FRET_val = {"Raw" : Raw_ratio, "Sergei" : Sergei_ratio,
+    FRET_val = {"Raw" : flat_raw, "Sergei" : flat_Sergei,
                 "Normalized raw" : norm_raw, "Normalized sergei" : norm_Sergei
                 }
     
     return FRET_val
 
 
+def normalized_pair(values, dataset, parameters):
+    """ Flat timepoint-major values normalized to each cell's baseline 
+        and to its first timepoint. """
+
+    Cell_number = dataset.cells
+    baseline = baseline_references(values, Cell_number, dataset.time, parameters)
+    return (normalize(values, Cell_number, baseline),
+            normalize(values, Cell_number, values[0:Cell_number]))
+
+
+def baseline_references(values, Cell_number, times, parameters):
+    """ Baseline of every cell, from flat timepoint-major values: the mean
+        or median of the first Control_num timepoints, or the mean of the
+        timepoints within the baseline window (minutes). """
+
+    if parameters["norm_mode"] == 1:
+        points = [index for index, time in enumerate(times)
+                  if parameters["norm_start"] <= time <= parameters["norm_end"]]
+    else:
+        points = range(min(Control_num, len(times)))
+
+    if not points:
+        IJ.log("No timepoints in the normalization baseline, values set to NaN.")
+        return [float("nan")] * Cell_number
+
+    references = []
+    for cell in range(Cell_number):
+        series = [values[point * Cell_number + cell] for point in points]
+        if parameters["norm_mode"] == 2:
+            series.sort()
+            middle = len(series) // 2
+            if len(series) % 2:
+                references.append(series[middle])
+            else:
+                references.append((series[middle - 1] + series[middle]) / 2.0)
+        else:
+            references.append(sum(series) / len(series))
+    return references
+
+
+def normalize(values, Cell_number, references):
+    """ Divides flat timepoint-major values by their cell's reference in
+        one pass. Cells with a zero or NaN reference become NaN, only zero
+        baselines are logged. """
+
+    guarded = []
+    for cell, reference in enumerate(references):
+        if reference == 0:
+            IJ.log("Cell " + str(cell + 1) + " has a zero baseline, normalized to NaN.")
+            reference = float("nan")
+        guarded.append(reference)
+
+    cells = itertools.cycle(guarded)
+    return [value / reference for value, reference in itertools.izip(values, cells)]
+
+
+def divide(numerator, denominator):
+    """ Division as NumPy does it: x/0 is +-inf and 0/0 is NaN. """
+
+    try:
+        return numerator / denominator
+    except ZeroDivisionError:
+        if numerator == 0 or numerator != numerator:
+            return float("nan")
+        return copysign(float("inf"), numerator) * copysign(1.0, denominator)
+
+
+def fret_engine(IDD, IDA, IAA=None, AER=0.0, DER=0.0, subtr_ratio=0.0):
+    """ Computes all FRET quantities of the cells x timepoints intensities
+        (flat, timepoint-major sequences) in one batched pass, with NumPy if
+        available. Returns flat, timepoint-major arrays: Raw, cFRET, dFRET,
+        aFRET, DtoA, A_Conc and D_Conc with IAA (3 channels), else Raw and 
+        Sergei. cFRET is computed once and reused. """
+
+    if numpy is not None:
+        idd = numpy.fromiter(IDD, numpy.float64, len(IDD))
+        ida = numpy.fromiter(IDA, numpy.float64, len(IDA))
+        raw = ida / idd
+        if IAA is None:
+            return {"Raw" : raw, "Sergei" : raw - subtr_ratio}
+
+        iaa = numpy.fromiter(IAA, numpy.float64, len(IAA))
+        cfret = ida - AER*iaa - DER*idd
+        a_conc = iaa * AER
+        d_conc = idd + cfret
+        return {"Raw" : raw, "cFRET" : cfret, "dFRET" : cfret / d_conc,
+                "aFRET" : (cfret / a_conc) / 4.66, "DtoA" : (d_conc / 4.66) / a_conc,
+                "A_Conc" : a_conc, "D_Conc" : d_conc}
+
+    if IAA is None:
+        values = dict((key, flat_array("d")) for key in ("Raw", "Sergei"))
+        for dd, da in itertools.izip(IDD, IDA):
+            raw = divide(da, dd)
+            values["Raw"].append(raw)
+            values["Sergei"].append(raw - subtr_ratio)
+        return values
+
+    keys = ("Raw", "cFRET", "dFRET", "aFRET", "DtoA", "A_Conc", "D_Conc")
+    values = dict((key, flat_array("d")) for key in keys)
+    columns = [values[key] for key in keys]
+    for dd, da, aa in itertools.izip(IDD, IDA, IAA):
+        cfret = da - AER*aa - DER*dd
+        a_conc = aa * AER
+        d_conc = dd + cfret
+        for column, value in zip(columns, (divide(da, dd), cfret,
+                                           divide(cfret, d_conc),
+                                           divide(cfret, a_conc) / 4.66,
+                                           divide(d_conc / 4.66, a_conc),
+                                           a_conc, d_conc)):
+            column.append(value)
+    return values
+
+
 		
-def Compositor(timepoints, channels, dirs):
-	""" Creates composite images of all channels for each timepoint. """
-	 	
-  	# Creates composite stack from HDD images.
- 	for time in range (1, (timepoints*channels), channels):
-  		
-  		stack = IJ.run(
-  		    "Image Sequence...", "open="
-  		    + dirs["Projections"] + " number=" + str(channels)
-  		    + " starting=" + str(time) + " increment=1 scale=400 file=.tif sort")
-        
-  		comp = IJ.run("Make Composite", "display=Composite")
-  		comp = IJ.run("Stack to RGB", comp)
-       
-  		IJ.saveAs(comp, "Tiff", os.path.join(dirs["Composites"],
-  		         "Timepoint"+str(time/channels).zfill(3)))
+def Compositor(scan, processors, dirs):
+	""" Creates the RGB composite of all channels of one timepoint directly
+	    from the in-memory projections, as 'Make Composite' + 'Stack to RGB'
+	    render it (C0 red, C1 green, C2 blue, each scaled to its own range). """
 
-		# Close windows.
-  		for i in range (2):
-  			try:
-  				imp = WindowManager.getCurrentImage()
-  				imp.close()
-  			except:
-  				pass
+	width, height = processors[0].getWidth(), processors[0].getHeight()
 
+	rgb = []
+	for ip in processors[:3]:
+		ip.resetMinAndMax()
+		rgb.append(ip.convertToByte(True).getPixels())
+	while len(rgb) < 3:
+		rgb.append(zeros(width*height, "b"))
 
-def Backgroundremoval(dirs, parameters):
-	""" Runs rolling ball background subtraction on all channels. """
-	
-	# Processes channel 1.. etc
-	for root, directories, filenames in os.walk(dirs["Projections_C0"]):
-		for filename in filenames:
-      		# Check for file extension
-			if filename.endswith(".tif"):		
-				process(dirs["Projections_C0"], root, filename, parameters)
+	composite = ColorProcessor(width, height)
+	composite.setRGB(rgb[0], rgb[1], rgb[2])
 
-	for root, directories, filenames in os.walk(dirs["Projections_C1"]):
-		for filename in filenames:
-      		# Check for file extension
-			if filename.endswith(".tif"):		
-				process(dirs["Projections_C1"], root, filename, parameters)
+	name = "Timepoint" + str(scan).zfill(3)
+	path = os.path.join(dirs["Composites"], name + ".tif")
+	if not FileSaver(ImagePlus(name, composite)).saveAsTiff(path):
+		raise IOError("Could not save " + path)
 
-	for root, directories, filenames in os.walk(dirs["Projections_C2"]):
-		for filename in filenames:
-      		# Check for file extension
-			if filename.endswith(".tif"):		
-				process(dirs["Projections_C2"], root, filename, parameters)
+
+def Backgroundremoval(dirs, parameters):
+	""" Runs rolling ball background subtraction on all channels,
+	    all channel/timepoint images concurrently on a worker pool. """
+	
+	workers = parameters["workers"]
+
+	# Processes channel 1.. etc, in place in the projection store.
+	series = [channel_projections(dirs, channel) for channel in range(3)]
+	series = [paths for paths in series if paths]
+	IJ.log("Background removal: " + str(sum(len(paths) for paths in series))
+	       + " images on " + str(workers) + " workers")
+
+	# 1 = estimate on a downsampled copy.
+	shrink = 1
+	if parameters["b_engine"] == 1:
+		shrink = parameters["b_shrink"]
+	reuse = parameters["b_reuse"]
+
+	# Each worker owns its BackgroundSubtracter.
+	if shrink == 1 and not reuse:
+		def subtract(b, path):
+			process(os.path.dirname(path), os.path.dirname(path),
+			        os.path.basename(path), parameters, b)
+
+		worker_pool([path for paths in series for path in paths], 
+		            subtract, workers, BackgroundSubtracter)
+		return
+
+	if shrink > 1:
+		for paths in series:
+			background_error(paths[0], parameters, shrink)
+
+	# A reused background model needs the timepoints of a channel in order,
+	# channels then run in parallel, otherwise every image is its own task.
+	if reuse:
+		tasks = series
+	else:
+		tasks = [[path] for paths in series for path in paths]
+
+	def subtract(b, paths):
+		background_engine(paths, parameters, b, shrink, reuse)
+
+	worker_pool(tasks, subtract, workers, BackgroundSubtracter)
 
  		
-def process(Destination_Directory, Current_Directory, filename, parameters):
+def process(Destination_Directory, Current_Directory, filename, parameters, b=None):
     """ Rolling ball method. """
     
-    print "Processing:"   
-    # Opening the image
-    print "Open image file", filename
-	
     imp = IJ.openImage(os.path.join(Current_Directory, filename))
     ip = imp.getProcessor()
-	
+
     # Parameters: Image processor, Rolling Ball Radius, Create background, 
     #             light background, use parabaloid, do pre smoothing (3x3), 
-    # 			  correct corners
-    b = BackgroundSubtracter()	
+    #             correct corners
+    if b is None:
+        b = BackgroundSubtracter()
     b.rollingBallBackground(ip, 
-	                        float(parameters["ballsize"]),
-	                        ast.literal_eval(parameters["create_b"]),
-	                        ast.literal_eval(parameters["light_b"]),
-	                        ast.literal_eval(parameters["parab"]),
-	                        ast.literal_eval(parameters["smooth"]),
-	                        ast.literal_eval(parameters["corners"])
+                            parameters["ballsize"],
+                            parameters["create_b"],
+                            parameters["light_b"],
+                            parameters["parab"],
+                            parameters["smooth"],
+                            parameters["corners"]
                             )
 
-    print "Saving to", Destination_Directory	
-    IJ.saveAs(imp, "Tiff", os.path.join(Destination_Directory, filename))	
+    # FileSaver rather than IJ.saveAs, images are saved from worker threads.
+    if not FileSaver(imp).saveAsTiff(os.path.join(Destination_Directory, filename)):
+        raise IOError("Could not save " + os.path.join(Destination_Directory, filename))
     imp.close()
 
 
+def estimate_background(ip, parameters, b, shrink):
+    """ Rolling ball background of a 32-bit image, estimated on a copy
+        shrunk by 'shrink' (ball radius scaled along) and scaled back up. """
+
+    width, height = ip.getWidth(), ip.getHeight()
+    if shrink > 1:
+        background = ip.resize(width/shrink, height/shrink, True)
+    else:
+        background = ip.duplicate()
+
+    b.rollingBallBackground(background,
+                            parameters["ballsize"]/shrink, True,
+                            parameters["light_b"],
+                            parameters["parab"],
+                            parameters["smooth"],
+                            parameters["corners"]
+                            )
+
+    if shrink > 1:
+        background.setInterpolationMethod(ImageProcessor.BILINEAR)
+        background = background.resize(width, height)
+    return background
+
+
+def relative_difference(ip, reference):
+    """ Mean absolute difference of two images relative to the mean of reference. """
+
+    diff = ip.duplicate()
+    diff.copyBits(reference, 0, 0, Blitter.DIFFERENCE)
+    mean = ImageStatistics.getStatistics(reference, Measurements.MEAN, None).mean
+    if mean == 0:
+        return float("inf")
+    return ImageStatistics.getStatistics(diff, Measurements.MEAN, None).mean / mean
+
+
+def background_error(path, parameters, shrink):
+    """ Logs the error of the downsampled background vs. the full-resolution
+        one for an image, relative to its mean intensity (NaN for a blank
+        image). """
+
+    ip = IJ.openImage(path).getProcessor().convertToFloat()
+    b = BackgroundSubtracter()
+    diff = estimate_background(ip, parameters, b, shrink)
+    diff.copyBits(estimate_background(ip, parameters, b, 1), 0, 0, Blitter.DIFFERENCE)
+
+    # A blank image has no relative error, it is logged as NaN.
+    mean = ImageStatistics.getStatistics(ip, Measurements.MEAN, None).mean
+    error = float("nan")
+    if mean != 0:
+        error = ImageStatistics.getStatistics(diff, Measurements.MEAN, None).mean / mean
+    IJ.log("Background error (x" + str(shrink) + " downsampled), " 
+           + os.path.basename(path) + ": " 
+           + str(round(100*error, 3)) + " % of mean intensity")
+
+
+def background_engine(paths, parameters, b, shrink, reuse):
+    """ Background subtraction of timepoints of one channel, in order.
+        With reuse, a background is kept while the (downsampled) image
+        stays within 'b_reuse_tol' of the image it was estimated from. """
+
+    tolerance = parameters["b_reuse_tol"]
+    create_b = parameters["create_b"]
+    model = None
+    reused = 0
+
+    for path in paths:
+        imp = IJ.openImage(path)
+        ip = imp.getProcessor().convertToFloat()
+
+        # Similarity is checked at the resolution the background is estimated at.
+        if shrink > 1:
+            small = ip.resize(ip.getWidth()/shrink, ip.getHeight()/shrink, True)
+        else:
+            small = ip.duplicate()
+
+        if (reuse and model is not None
+                and relative_difference(small, model[0]) <= tolerance):
+            background = model[1]
+            reused += 1
+        else:
+            background = estimate_background(ip, parameters, b, shrink)
+            model = (small, background)
+
+        if create_b:
+            ip = background.duplicate()
+        else:
+            ip.copyBits(background, 0, 0, Blitter.SUBTRACT)
+        imp.setProcessor(ip)
+
+        if not FileSaver(imp).saveAsTiff(path):
+            raise IOError("Could not save " + path)
+        imp.close()
+
+    if reuse:
+        IJ.log("Background reused for " + str(reused) + " of " + str(len(paths))
+               + " images in " + os.path.basename(os.path.dirname(paths[0])))
+
+
 def Overlayer(org_size, dirs):
 	""" Overlays ROIs with appropriate color,
 	    saves to .tif and animates aligned images to .gif """
@@ -1080,34 +2511,25 @@ def user_input():
 	return User_Input_Dict, User_Input_Dict_JSON, Stim_List
 
 
-def plots(values, timelist, Cell_number, value_type, Stim_List, dirs, parameters):
+def plots(values, dataset, value_type, Stim_List, dirs, parameters):
     """ Plots all calculated values, saves plots to generated directory, returns plot scale. """
 
+    # Cells and time axis of the run.
+    Cell_number, timelist = dataset.cells, dataset.time
+
     Mean_plot = 0
-    # Flatten nested lists (normalized lists are not nested).
-    if value_type == "Normalized aFRET mean":    
-        values_concat = [ values[i:i+Cell_number] for i in range(0, (len(values)), Cell_number) ]
-        Mean_sd = [ standard_deviation(values_concat[i]) for i in range(len(values_concat)) ]
-        Mean_sd = [item for sublist in Mean_sd for item in sublist]
-        Mean_plot = 1
-    elif value_type == "Normalized dFRET mean":
-        values_concat = [ values[i:i+Cell_number] for i in range(0, (len(values)), Cell_number) ]
-        Mean_sd = [ standard_deviation(values_concat[i]) for i in range(len(values_concat)) ]
-        Mean_sd = [item for sublist in Mean_sd for item in sublist]
+    # Values are flat and timepoint-major (cells per timepoint).
+    if value_type in ("Normalized aFRET mean", "Normalized dFRET mean"):
+        # Mean and SD of all cells per timepoint, one pass.
+        per_timepoint = running_stats.matrix_stats(values, Cell_number)[0]
+        Means = [ stats.mean for stats in per_timepoint ]
+        SDs = [ stats.sd() for stats in per_timepoint ]
         Mean_plot = 1
 
-    else:
-        if "Normalized" not in value_type:
-            values = [item for sublist in values for item in sublist]
-
-    #Repeats list items x cell_number (match timepoints with # of cells).
-    timelist = [x for item in timelist for x in repeat(item, Cell_number)]
-
     # Scaling of plots.
     max_Y = 1
     if max(values) > 3:
-        if not isinstance(values[0], list):
-            max_Y = max(values)*1.3
+        max_Y = max(values)*1.3
     elif max(values) > 2.5:
         max_Y = 3.3
     elif max(values) > 2:
@@ -1145,14 +2567,14 @@ def plots(values, timelist, Cell_number, value_type, Stim_List, dirs, parameters
 
     # Scaling of normalized plots..
     if "Normalized" in value_type:
-        min_Y, max_Y = float(parameters["p_min_n"]), float(parameters["p_max_n"])
+        min_Y, max_Y = parameters["p_min_n"], parameters["p_max_n"]
 
     if value_type == "dFRET":
-        max_Y = float(parameters["p_max"])
-        min_y = float(parameters["p_min"])
+        max_Y = parameters["p_max"]
+        min_y = parameters["p_min"]
     elif value_type =="aFRET":
-        max_Y = float(parameters["p_max"])
-        min_y = float(parameters["p_min"])
+        max_Y = parameters["p_max"]
+        min_y = parameters["p_min"]
 
     # Call plot, set scale.
     plot = Plot(Title, "Time (minutes)", value_type)
@@ -1176,12 +2598,12 @@ def plots(values, timelist, Cell_number, value_type, Stim_List, dirs, parameters
                 return
                     
             plot.setLineWidth(1.5)
-            plot.addPoints(timelist[i :: Cell_number], values[i :: Cell_number], Plot.LINE)
+            plot.addPoints(timelist, list(values[i :: Cell_number]), Plot.LINE)
             plot.setLineWidth(1)
 
             # Comment in to define color + fillcolor for circles.
             plot.setColor(Color(*Colors[i][0:3]), Color(*Colors[i][0:3]))
-            #plot.addPoints(timelist[i :: Cell_number], values[i :: Cell_number], Plot.CIRCLE)
+            #plot.addPoints(timelist, values[i :: Cell_number], Plot.CIRCLE)
     else:
         min_Y, max_Y = 0.6, 1.6
         if len(timelist) > 1:
@@ -1190,12 +2612,12 @@ def plots(values, timelist, Cell_number, value_type, Stim_List, dirs, parameters
             plot.setLimits(-1, 1, min_Y, max_Y)
         plot.setColor("Color.BLACK")
         plot.setLineWidth(1.5)
-        plot.addPoints(timelist[0 :: Cell_number], Mean_sd[0::2], Plot.LINE)
+        plot.addPoints(timelist, Means, Plot.LINE)
         plot.setLineWidth(1)
         plot.setColor("Color.BLACK", "Color.BLACK")
-        plot.addPoints(timelist[0 :: Cell_number], Mean_sd[0::2], Plot.CIRCLE)
+        plot.addPoints(timelist, Means, Plot.CIRCLE)
         plot.setColor(Color(*Colors[6][0:3]))
-        plot.addErrorBars(Mean_sd[1::2])
+        plot.addErrorBars(SDs)
 
     # Get's stim name from input.
     if not Stim_List == False:
@@ -1369,21 +2791,6 @@ def colorlist():
 	return Colors, Colors_old
 
 	
-def standard_deviation(values):
-    count = len(values)
-    mean = sum(values) / count
-    differences = [ x - mean for x in values ]
-    sq_differences = [ d ** 2 for d in differences ]
-    ssd = sum(sq_differences)
-    if count > 1:
-        variance = ssd / (count - 1)
-    else:
-        variance = ssd / count
-
-    sd = sqrt(variance)
-    mean_sd_list = [mean, sd]
-    return mean_sd_list
-
 if __name__ in ["__main__", "__builtin__"]:
     main()
 
@@ -1,10 +1,14 @@
 # @File(label="Select a file") Experiment
 from ij import IJ
-from loci.formats import ImageReader
-from loci.formats import MetadataTools
-from ome.units import UNITS
-from datetime import datetime
-import time
+import os
+import sys
+
+# Shares the cached metadata routine with FRET_Analyser (lif_metadata.py).
+try:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    pass
+import lif_metadata
 
 def time_parser():
     """ Iterates through timelapse,                           """
@@ -12,27 +16,14 @@ def time_parser():
     """ - S. Grødem 2017                                      """
     
     # Get metadata.
-    reader = ImageReader()
-    omeMeta = MetadataTools.createOMEXMLMetadata()
-    reader.setMetadataStore(omeMeta)
-    reader.setId(str(Experiment))
+    meta = lif_metadata.read_metadata(str(Experiment))
 
 	# Extracts number of image series, channel number
-    seriesCount = reader.getSeriesCount()
-    reader.close()
+    seriesCount = meta["series_count"]
 
     # Gets timepoints, in minutes.
-    timelist = []
-    namelist = []
-    
-    for timepoint in range (seriesCount):
-        times = omeMeta.getImageAcquisitionDate(timepoint)
-        timelist.append(times.toString())
-        namelist.append(omeMeta.getImageName(timepoint))
-
-    # YY.MM... to minutes.
-    timelist =[ time.mktime(time.strptime(times, u'%Y-%m-%dT%H:%M:%S')) for times in timelist ]
-    timelist_unsorted =[ (times - timelist[0])/60 for times in timelist ]
+    timelist_unsorted = lif_metadata.acquisition_minutes(meta)
+    namelist = meta["names"]
 
     # Sort timepoints.
     timelist, namelist = zip(*sorted(zip(timelist_unsorted, namelist)))
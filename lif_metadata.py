@@ -0,0 +1,114 @@
+from ij import IJ
+from loci.formats import ImageReader
+from loci.formats import MetadataTools
+import os
+import json
+import time
+
+# Bump when the cached fields change, older sidecars are then re-parsed.
+CACHE_VERSION = 2
+
+
+def sidecar_path(path):
+    """ Path of the metadata cache file kept next to the experiment. """
+
+    return str(path) + ".meta.json"
+
+
+def file_key(path):
+    """ Identifies one version of an experiment file (path, size, mtime). """
+
+    path = os.path.abspath(str(path))
+    return {"path" : path,
+            "size" : os.path.getsize(path),
+            "mtime" : int(os.path.getmtime(path) * 1000)
+            }
+
+
+def extract_metadata(path):
+    """ Parses .lif XML/OME metadata with Bio-Formats, returns a dict of """
+    """ the values used by the analysers (series, channels, timestamps..). """
+
+    # Get metadata.
+    reader = ImageReader()
+    omeMeta = MetadataTools.createOMEXMLMetadata()
+    reader.setMetadataStore(omeMeta)
+    reader.setId(str(path))
+
+    # Extracts number of image series, channel number.
+    seriesCount = reader.getSeriesCount()
+    channels = reader.getSizeC()
+    reader.close()
+
+    imageCount = omeMeta.getImageCount()
+
+    # Acquisition timestamps and names of every series.
+    dates, names = [], []
+    for series in range(imageCount):
+        date = omeMeta.getImageAcquisitionDate(series)
+        dates.append(date.toString() if date is not None else None)
+        names.append(omeMeta.getImageName(series))
+
+    # Image size in pixels AND microns (for scalebar).
+    Physical_x = omeMeta.getPixelsPhysicalSizeX(0)
+    Pixel_x = omeMeta.getPixelsSizeX(0)
+    Pixel_y = omeMeta.getPixelsSizeY(0)
+
+    # Attenuation of donor excitation laser (3 channel experiments only).
+    attenuation = None
+    if channels == 3:
+        LP = omeMeta.getChannelLightSourceSettingsAttenuation(0, 0)
+        if LP is not None:
+            attenuation = float(LP.getNumberValue())
+
+    return {"series_count" : seriesCount,
+            "channels" : channels,
+            "image_count" : imageCount,
+            "dates" : dates,
+            "names" : names,
+            "physical_x" : float(Physical_x.value()),
+            "pixel_x" : int(Pixel_x.getNumberValue()),
+            "pixel_y" : int(Pixel_y.getNumberValue()),
+            "attenuation" : attenuation
+            }
+
+
+def read_metadata(path):
+    """ Returns metadata of an experiment, from the sidecar cache if it """
+    """ matches the current file, else parses the file and updates it. """
+
+    key = file_key(path)
+    cache = sidecar_path(path)
+
+    if os.path.exists(cache):
+        try:
+            with open(cache, "r") as cachefile:
+                cached = json.load(cachefile)
+            if (cached.get("version") == CACHE_VERSION
+                    and cached.get("key") == key):
+                IJ.log("Metadata read from cache: " + cache)
+                return cached["metadata"]
+        except (IOError, ValueError), e:
+            print "Ignoring unreadable metadata cache:", str(e)
+
+    metadata = extract_metadata(path)
+
+    # A read-only experiment directory only costs the cache.
+    try:
+        with open(cache, "w") as cachefile:
+            json.dump({"version" : CACHE_VERSION, "key" : key,
+                       "metadata" : metadata}, cachefile, sort_keys=True)
+    except (IOError, OSError), e:
+        print "Could not write metadata cache:", str(e)
+
+    return metadata
+
+
+def acquisition_minutes(metadata):
+    """ Acquisition times in minutes relative to the first series, """
+    """ in series (unsorted) order. """
+
+    # YY.MM... to minutes.
+    timelist = [ time.mktime(time.strptime(times, u'%Y-%m-%dT%H:%M:%S'))
+                 for times in metadata["dates"] ]
+    return [ (times - timelist[0])/60 for times in timelist ]
@@ -0,0 +1,74 @@
+from math import sqrt
+
+
+class RunningStats(object):
+    """ Single-pass (Welford) accumulator for n, mean, SD, SEM, min and max.
+        Stable for large intensity values, NaN values are skipped. The mean
+        is NaN without values. """
+
+    __slots__ = ("n", "_mean", "m2", "min", "max")
+
+    def __init__(self, values=()):
+        self.n = 0
+        self._mean = 0.0
+        self.m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.extend(values)
+
+    def push(self, value):
+        if value != value:
+            return
+        self.n += 1
+        delta = value - self._mean
+        self._mean += delta / self.n
+        self.m2 += delta * (value - self._mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if self.n == 0:
+            return float("nan")
+        return self._mean
+
+    def extend(self, values):
+        for value in values:
+            self.push(value)
+
+    def variance(self):
+        """ Sample variance, 0 for a single value, NaN without values. """
+
+        if self.n == 0:
+            return float("nan")
+        if self.n == 1:
+            return 0.0
+        return self.m2 / (self.n - 1)
+
+    def sd(self):
+        return sqrt(self.variance())
+
+    def sem(self):
+        if self.n == 0:
+            return float("nan")
+        return self.sd() / sqrt(self.n)
+
+
+def matrix_stats(values, cells):
+    """ Statistics per timepoint and per cell of flat, timepoint-major
+        values (cells per timepoint) in one pass over the matrix.
+        Returns (per timepoint, per cell) lists of RunningStats. """
+
+    per_timepoint = []
+    per_cell = [RunningStats() for cell in range(cells)]
+
+    for index, value in enumerate(values):
+        cell = index % cells
+        if cell == 0:
+            per_timepoint.append(RunningStats())
+        per_timepoint[-1].push(value)
+        per_cell[cell].push(value)
+
+    return per_timepoint, per_cell
@@ -0,0 +1,81 @@
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from running_stats import RunningStats, matrix_stats
+
+
+def two_pass(values):
+    """ Reference mean and sample variance, computed in two passes. """
+
+    mean = sum(values) / len(values)
+    return mean, sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+
+
+def test_matches_two_pass():
+    rng = random.Random(1)
+    values = [rng.gauss(100.0, 15.0) for index in range(1000)]
+    stats = RunningStats(values)
+    mean, variance = two_pass(values)
+
+    assert stats.n == 1000
+    assert math.isclose(stats.mean, mean, rel_tol=1e-12)
+    assert math.isclose(stats.variance(), variance, rel_tol=1e-9)
+    assert math.isclose(stats.sd(), math.sqrt(variance), rel_tol=1e-9)
+    assert math.isclose(stats.sem(), math.sqrt(variance / 1000), rel_tol=1e-9)
+    assert stats.min == min(values)
+    assert stats.max == max(values)
+
+
+def test_stable_for_large_offsets():
+    # Naive sum of squares loses the variance entirely at this offset.
+    values = [1e9 + offset for offset in (4.0, 7.0, 13.0, 16.0)]
+    stats = RunningStats(values)
+
+    assert stats.mean == 1e9 + 10.0
+    assert math.isclose(stats.variance(), 30.0, rel_tol=1e-9)
+
+
+def test_nan_values_are_skipped():
+    nan = float("nan")
+    stats = RunningStats([nan, 1.0, nan, 2.0, 3.0, nan])
+
+    assert stats.n == 3
+    assert stats.mean == 2.0
+    assert stats.variance() == 1.0
+    assert stats.min == 1.0
+    assert stats.max == 3.0
+
+
+def test_empty_and_single_value():
+    empty = RunningStats()
+    assert empty.n == 0
+    assert math.isnan(empty.mean)
+    assert math.isnan(empty.variance())
+    assert math.isnan(empty.sem())
+
+    only_nan = RunningStats([float("nan")])
+    assert only_nan.n == 0
+    assert math.isnan(only_nan.mean)
+
+    single = RunningStats([5.0])
+    assert single.mean == 5.0
+    assert single.variance() == 0.0
+    assert single.sem() == 0.0
+
+
+def test_matrix_stats():
+    nan = float("nan")
+    # 3 timepoints x 2 cells, timepoint-major.
+    values = [1.0, 10.0,
+              2.0, nan,
+              3.0, 30.0]
+    per_timepoint, per_cell = matrix_stats(values, 2)
+
+    assert [stats.mean for stats in per_timepoint] == [5.5, 2.0, 16.5]
+    assert [stats.n for stats in per_timepoint] == [2, 1, 2]
+    assert [stats.mean for stats in per_cell] == [2.0, 20.0]
+    assert [stats.n for stats in per_cell] == [3, 2]